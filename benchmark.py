@@ -0,0 +1,590 @@
+#!/usr/bin/env python
+
+"""benchmark.py -- offline benchmarks of ConferenceApi on testbed stubs
+
+Builds a synthetic data set (users, conferences, sessions per conference,
+wishlists and registrations) on the App Engine testbed stubs, then times
+every ConferenceApi method and the main.app task, cron and admin handlers,
+counting the RPCs each call makes.  It also runs a seat contention run
+(concurrent registrations for one conference) and times the entity-to-form
+mappers on 10,000 conferences.
+
+Results are written as JSON; given a baseline from an earlier run, any
+method that got slower by more than the tolerance or makes more RPCs is
+reported and the script exits non-zero.
+
+    python benchmark.py --sdk ~/google_appengine --out bench.json
+    python benchmark.py --sdk ~/google_appengine --baseline bench.json
+
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from datetime import date
+from datetime import timedelta
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CITIES = ['London', 'Chicago', 'Paris', 'Tokyo', 'Nairobi', 'Sydney', 'Lima']
+TOPICS = ['Medical Innovations', 'Programming Languages', 'Web Technologies',
+          'Movie Making', 'Health and Nutrition']
+SESSION_TYPES = ['Workshop', 'Lecture', 'Keynote', 'Panel']
+SPEAKERS = ['Speaker %d' % i for i in range(20)]
+EMAIL_DOMAIN = 'example.com'
+
+# ignore timing changes smaller than this, whatever the tolerance
+NOISE_FLOOR_MS = 1.0
+
+
+def setupPaths(sdk):
+    """Put the App Engine SDK and its bundled libraries on sys.path."""
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, APP_DIR)
+
+
+def activateTestbed():
+    """Activate the datastore, memcache, taskqueue, user and other stubs."""
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(app_id='conference-benchmark', overwrite=True,
+        ENDPOINTS_AUTH_EMAIL='', ENDPOINTS_AUTH_DOMAIN=EMAIL_DOMAIN)
+    # every query sees every committed write, so runs are repeatable
+    bed.init_datastore_v3_stub(consistency_policy=
+        datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=APP_DIR)
+    bed.init_user_stub()
+    bed.init_mail_stub()
+    bed.init_app_identity_stub()
+    bed.init_blobstore_stub()
+    bed.init_urlfetch_stub()
+    return bed
+
+
+class HandlerError(Exception):
+    """Raised when main.app answers a benchmark request with a 5xx."""
+
+
+def email(user):
+    return 'user%d@%s' % (user, EMAIL_DOMAIN)
+
+
+def asUser(user):
+    """Make endpoints.get_current_user() return the given synthetic user."""
+    os.environ['ENDPOINTS_AUTH_EMAIL'] = email(user)
+
+
+def summarize(times, rpcs, errors=0):
+    """Return the statistics recorded for one benchmark."""
+    times = sorted(times)
+    return {
+        'calls': len(times),
+        'median_ms': round(times[len(times) // 2], 3),
+        'p90_ms': round(times[min(len(times) - 1, int(len(times) * 0.9))], 3),
+        'max_ms': round(times[-1], 3),
+        'rpcs': round(float(sum(rpcs)) / len(rpcs), 2),
+        'errors': errors,
+    }
+
+
+class Benchmark(object):
+    """Synthetic data set plus the timed calls against it."""
+
+    def __init__(self, args):
+        # the app is imported only once the SDK is on sys.path
+        from google.appengine.ext import ndb
+        from google.appengine.ext import testbed
+        from protorpc import remote
+        import conference
+        import main
+        import mappers
+        import models
+        import rpcstats
+        import seats
+
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.ndb = ndb
+        self.remote = remote
+        self.conference = conference
+        self.main = main
+        self.mappers = mappers
+        self.models = models
+        self.rpcstats = rpcstats
+        self.seats = seats
+        self.api = conference.ConferenceApi()
+        # sampled calls would add their own memcache writes to the counts
+        rpcstats.STATS_SAMPLE_RATE = 0
+        self.taskqueue = args.bed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        self.results = {'api': {}, 'tasks': {}}
+
+    # - - - Measurement - - - - - - - - - - - - - - - - - - - - - -
+
+    def measure(self, call, repeat):
+        """Run call(i) `repeat` times, each as a fresh request; return
+        (times in ms, RPC counts, errors)."""
+        times, rpcs, errors = [], [], 0
+        for i in range(repeat):
+            self.ndb.get_context().clear_cache()
+            with self.rpcstats.recording() as recorder:
+                start = time.time()
+                try:
+                    call(i)
+                except (self.remote.ApplicationError, HandlerError) as e:
+                    logging.warning('%s', e)
+                    errors += 1
+                times.append((time.time() - start) * 1000)
+            rpcs.append(recorder.rpcs)
+        return times, rpcs, errors
+
+    def timeApi(self, name, call, repeat=None):
+        times, rpcs, errors = self.measure(call, repeat or self.args.repeat)
+        self.results['api'][name] = summarize(times, rpcs, errors)
+
+    def runTasks(self):
+        """Run every queued task through main.app, timing each by URL."""
+        by_url = {}
+        while True:
+            tasks = self.taskqueue.get_filtered_tasks()
+            if not tasks:
+                break
+            self.taskqueue.FlushQueue('default')
+            for task in tasks:
+                times, rpcs, errors = by_url.setdefault(task.url, ([], [], [0]))
+                t, r, e = self.measure(lambda i: self.request(task.url,
+                    task.method, task.payload, task.headers), 1)
+                times.extend(t)
+                rpcs.extend(r)
+                errors[0] += e
+        for url, (times, rpcs, errors) in by_url.items():
+            self.results['tasks'][url] = summarize(times, rpcs, errors[0])
+
+    def request(self, url, method='GET', body=None, headers=None):
+        """Send one request to main.app; raise HandlerError on a 5xx."""
+        import webapp2
+        req = webapp2.Request.blank(url)
+        req.method = method
+        if headers:
+            req.headers.update(headers)
+        if body:
+            req.body = body
+            req.headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+        response = req.get_response(self.main.app)
+        if response.status_int >= 500:
+            raise HandlerError('%s %s: %s' % (method, url, response.status))
+        return response
+
+    def timeHandler(self, url, method='GET', body=None):
+        times, rpcs, errors = self.measure(
+            lambda i: self.request(url, method, body), self.args.repeat)
+        self.results['tasks']['%s %s' % (method, url)] = summarize(times, rpcs, errors)
+
+    # - - - Data - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def conferenceForm(self, n):
+        start = date(2016, 1, 1) + timedelta(days=self.rng.randrange(365))
+        return self.models.ConferenceForm(
+            name='Conference %d' % n,
+            description='Description of conference %d. ' % n * 20,
+            city=self.rng.choice(CITIES),
+            topics=self.rng.sample(TOPICS, self.rng.randint(1, 3)),
+            startDate=str(start),
+            endDate=str(start + timedelta(days=self.rng.randint(0, 4))),
+            maxAttendees=self.rng.choice([3, 5, 10, 50, 100, 500]),
+        )
+
+    def sessionForm(self, wsck, n):
+        return self.models.SessionForm(
+            name='Session %d' % n,
+            highlights='Highlights of session %d' % n,
+            speaker=self.rng.choice(SPEAKERS),
+            duration=self.rng.choice([30, 45, 60, 90]),
+            typeOfSession=[self.rng.choice(SESSION_TYPES)],
+            date='2016-%02d-%02d' % (self.rng.randint(1, 12), self.rng.randint(1, 28)),
+            startTime='%02d:%02d' % (self.rng.randint(8, 20), self.rng.choice([0, 30])),
+            confwebsafeKey=wsck,
+        )
+
+    def populate(self):
+        """Create the synthetic data set through the API."""
+        args = self.args
+        start = time.time()
+        for user in range(args.users):
+            asUser(user)
+            self.api.saveProfile(self.models.ProfileMiniForm(
+                displayName='User %d' % user,
+                teeShirtSize=self.models.TeeShirtSize.M_M))
+        for n in range(args.conferences):
+            asUser(n % args.users)
+            self.api.createConference(self.conferenceForm(n))
+
+        Conference = self.models.Conference
+        self.conferences = [key.urlsafe() for key in
+            Conference.query().fetch(keys_only=True)]
+        for n, wsck in enumerate(self.conferences):
+            asUser(n % args.users)
+            self.api.createSessions(self.models.SessionForms(items=[
+                self.sessionForm(wsck, n * args.sessions + i)
+                for i in range(args.sessions)]))
+
+        self.sessions = [key.urlsafe() for key in
+            self.models.Session.query().fetch(keys_only=True)]
+        for user in range(args.users):
+            asUser(user)
+            self.api.addSessionsToWishlist(self.models.WishlistBatchForm(
+                websafeSessionKeys=self.rng.sample(self.sessions,
+                    min(args.wishlist, len(self.sessions)))))
+            for wsck in self.rng.sample(self.conferences,
+                    min(args.registrations, len(self.conferences))):
+                try:
+                    self.api.registerForConference(self.confRequest(wsck))
+                except self.remote.ApplicationError:
+                    pass  # sold out
+        self.runTasks()
+        self.results['tasks'] = {}
+        self.results['populate_s'] = round(time.time() - start, 3)
+
+    def confRequest(self, wsck, container=None):
+        container = container or self.conference.CONF_GET_REQUEST
+        return container.combined_message_class(websafeConferenceKey=wsck)
+
+    def owner(self, wsck):
+        """Return the email of the user who created a conference."""
+        return self.ndb.Key(urlsafe=wsck).parent().id()
+
+    # - - - Benchmarks - - - - - - - - - - - - - - - - - - - - - - -
+
+    def benchApi(self):
+        """Time every ConferenceApi method."""
+        api, models, conference = self.api, self.models, self.conference
+        rng, args = self.rng, self.args
+        FULL, SUMMARY = models.ConferenceView.FULL, models.ConferenceView.SUMMARY
+        user = 0
+        asUser(user)
+        wsck = self.conferences[0]
+        mine = [w for w in self.conferences if self.owner(w) == email(user)]
+
+        self.timeApi('getProfile', lambda i: api.getProfile(
+            models.ConditionalRequest()))
+        etag = api.getProfile(models.ConditionalRequest()).etag
+        self.timeApi('getProfile[notModified]', lambda i: api.getProfile(
+            models.ConditionalRequest(etag=etag)))
+        self.timeApi('saveProfile', lambda i: api.saveProfile(
+            models.ProfileMiniForm(displayName='User %d (%d)' % (user, i))))
+        self.timeApi('createConference', lambda i: api.createConference(
+            self.conferenceForm(args.conferences + i)))
+        self.timeApi('updateConference', lambda i: api.updateConference(
+            conference.CONF_POST_REQUEST.combined_message_class(
+                websafeConferenceKey=mine[i % len(mine)],
+                description='Updated %d' % i)))
+        self.timeApi('getConference', lambda i: api.getConference(
+            self.confRequest(rng.choice(self.conferences), conference.CONF_ETAG_REQUEST)))
+        etags = dict((w, api.getConference(self.confRequest(w, conference.CONF_ETAG_REQUEST)).etag)
+                     for w in self.conferences)
+        self.timeApi('getConference[notModified]', lambda i: api.getConference(
+            conference.CONF_ETAG_REQUEST.combined_message_class(
+                websafeConferenceKey=self.conferences[i % len(self.conferences)],
+                etag=etags[self.conferences[i % len(self.conferences)]])))
+        for view in (FULL, SUMMARY):
+            self.timeApi('getConferencesCreated[%s]' % view, lambda i:
+                api.getConferencesCreated(conference.CONF_PAGE_REQUEST
+                    .combined_message_class(view=view)))
+            self.timeApi('getConferencesToAttend[%s]' % view, lambda i:
+                api.getConferencesToAttend(conference.CONF_LIST_REQUEST
+                    .combined_message_class(view=view)))
+            etag = api.getConferencesToAttend(conference.CONF_LIST_REQUEST
+                .combined_message_class(view=view)).etag
+            self.timeApi('getConferencesToAttend[%s,notModified]' % view, lambda i:
+                api.getConferencesToAttend(conference.CONF_LIST_REQUEST
+                    .combined_message_class(view=view, etag=etag)))
+        queries = {
+            'all': [],
+            'city': [('CITY', 'EQ', 'London')],
+            'range': [('MONTH', 'GT', '3'), ('MAX_ATTENDEES', 'LT', '100')],
+            'mixed': [('CITY', 'NE', 'Paris'), ('TOPIC', 'EQ', TOPICS[0]),
+                      ('MONTH', 'LTEQ', '9')],
+        }
+        # repeated queries are served from the query cache; explain skips
+        # it, so the uncached runs time the query itself
+        for label, filters in sorted(queries.items()):
+            for view in (FULL, SUMMARY):
+                for cached in (True, False):
+                    self.timeApi('queryConferences[%s,%s%s]' % (
+                        label, view, '' if cached else ',uncached'), lambda i:
+                        api.queryConferences(models.ConferenceQueryForms(
+                            filters=[models.ConferenceQueryForm(field=f, operator=o, value=v)
+                                     for f, o, v in filters],
+                            view=view, explain=not cached)))
+        self.timeApi('getConferenceFacets', lambda i: api.getConferenceFacets(
+            conference.message_types.VoidMessage()))
+        searches = {
+            'common': 'conference',
+            'rare': 'conference %d' % (self.args.conferences // 2),
+            'miss': 'unmatched words',
+        }
+        for label, text in sorted(searches.items()):
+            for view in (FULL, SUMMARY):
+                self.timeApi('searchConferences[%s,%s]' % (label, view), lambda i:
+                    api.searchConferences(models.ConferenceSearchForm(
+                        query=text, view=view)))
+
+        self.timeApi('createSession', lambda i: api.createSession(
+            self.sessionForm(mine[0], 100000 + i)))
+        self.timeApi('createSessions', lambda i: api.createSessions(
+            models.SessionForms(items=[self.sessionForm(mine[0], 200000 + 10 * i + j)
+                                       for j in range(10)])))
+        speaker_request = api.getSessionsBySpeaker.remote.request_type
+        self.timeApi('getSessionsBySpeaker', lambda i: api.getSessionsBySpeaker(
+            speaker_request(speaker=rng.choice(SPEAKERS))))
+        self.timeApi('getConferenceSessions', lambda i: api.getConferenceSessions(
+            models.SessionQuery(websafeConferenceKey=rng.choice(self.conferences))))
+        self.timeApi('getConferenceSessionsByType', lambda i:
+            api.getConferenceSessionsByType(models.SessionQueryType(
+                websafeConferenceKey=rng.choice(self.conferences),
+                typeOfSession=rng.choice(SESSION_TYPES))))
+        self.timeApi('problematicQuery', lambda i: api.problematicQuery(
+            models.SessionQuery(websafeConferenceKey=rng.choice(self.conferences))))
+
+        session_queries = {
+            'type': [('TYPE', 'IN', 'Lecture,Keynote')],
+            'problematic': [('TYPE', 'NOT_IN', 'Workshop'),
+                            ('START_TIME', 'LTEQ', '19:00')],
+            'ranges': [('START_TIME', 'GTEQ', '10:00'), ('DURATION', 'LT', '60'),
+                       ('SPEAKER', 'NE', SPEAKERS[0])],
+        }
+        for label, filters in sorted(session_queries.items()):
+            for scope in ('all', 'conference'):
+                self.timeApi('querySessions[%s,%s]' % (label, scope), lambda i:
+                    api.querySessions(models.SessionQueryForms(
+                        websafeConferenceKey=(rng.choice(self.conferences)
+                                              if scope == 'conference' else None),
+                        filters=[models.SessionQueryFilter(field=f, operator=o, value=v)
+                                 for f, o, v in filters])))
+
+        fresh = iter(self.rng.sample(self.sessions, len(self.sessions)))
+        self.timeApi('addSessionToWishlist', lambda i: api.addSessionToWishlist(
+            models.WishlistForm(websafeSessionKey=next(fresh))))
+        self.timeApi('addSessionsToWishlist', lambda i: api.addSessionsToWishlist(
+            models.WishlistBatchForm(websafeSessionKeys=[next(fresh) for j in range(5)])))
+        self.timeApi('getSessionsInWishlist', lambda i: api.getSessionsInWishlist(
+            conference.message_types.VoidMessage()))
+        self.timeApi('returnWishlistType', lambda i: api.returnWishlistType(
+            models.WishlistTypeQuery(typeOfSession=rng.choice(SESSION_TYPES))))
+        self.timeApi('returnWishlistSpeaker', lambda i: api.returnWishlistSpeaker(
+            models.WishlistSpeakerQuery(speaker=rng.choice(SPEAKERS))))
+        self.timeApi('getWishlistConflicts', lambda i: api.getWishlistConflicts(
+            conference.message_types.VoidMessage()))
+        wished = [wish.websafeSessionKey for wish in api.getSessionsInWishlist(
+            conference.message_types.VoidMessage()).items]
+        self.timeApi('removeSessionFromWishlist', lambda i: api.removeSessionFromWishlist(
+            models.WishlistForm(websafeSessionKey=wished[i % len(wished)])))
+
+        self.timeApi('getConferenceAttendees', lambda i: api.getConferenceAttendees(
+            self.confRequest(mine[i % len(mine)])))
+        # register and unregister the same conferences, so seats are returned
+        roomy = [w for w in self.conferences
+                 if self.seats.getSeatsAvailable(self.ndb.Key(urlsafe=w).get()) > 0]
+        targets = self.rng.sample(roomy, min(args.repeat, len(roomy)))
+        if targets:
+            self.timeApi('registerForConference', lambda i: api.registerForConference(
+                self.confRequest(targets[i])), len(targets))
+            self.timeApi('unregisterFromConference', lambda i: api.unregisterFromConference(
+                self.confRequest(targets[i])), len(targets))
+
+        self.timeApi('getAnnouncement', lambda i: api.getAnnouncement(
+            models.ConditionalRequest()))
+        self.timeApi('getFeaturedSpeaker', lambda i: api.getFeaturedSpeaker(
+            conference.message_types.VoidMessage()))
+
+    def benchHandlers(self):
+        """Time the tasks queued by the API benchmarks and the cron, admin
+        and migration handlers of main.app."""
+        self.runTasks()
+        self.timeHandler('/crons/set_announcement')
+        self.timeHandler('/tasks/reconcile_announcement', 'POST')
+        self.timeHandler('/tasks/rebuild_facets', 'POST')
+        self.timeHandler('/admin/export?kind=conference&format=jsonl')
+        self.timeHandler('/admin/export?kind=session&format=csv')
+        self.timeHandler('/tasks/migrate_registrations', 'POST')
+        self.timeHandler('/tasks/migrate_wishlists', 'POST')
+
+    def benchContention(self):
+        """Register many users concurrently for one conference and report
+        throughput and how many commits were retried."""
+        args, ndb = self.args, self.ndb
+        api, seats = self.api, self.seats
+        Profile = self.models.Profile
+        users = args.threads * args.per_thread
+        asUser(0)
+        self.api.createConference(self.models.ConferenceForm(
+            name='Contended', maxAttendees=users))
+        conf = self.models.Conference.query(
+            self.models.Conference.name == 'Contended').get()
+        p_keys = [ndb.Key(Profile, 'contender%d@%s' % (i, EMAIL_DOMAIN))
+                  for i in range(users)]
+        ndb.put_multi([Profile(key=p_key, displayName=p_key.id(),
+                               mainEmail=p_key.id()) for p_key in p_keys])
+
+        outcome = {'registered': 0, 'failed': 0, 'errors': 0, 'commits': 0}
+        lock = threading.Lock()
+
+        def register(p_keys):
+            # the seat-taking loop of ConferenceApi._conferenceRegistration,
+            # minus the endpoints user lookup; a ConflictException is the
+            # endpoint's 409, anything else would be a 500
+            with self.rpcstats.recording() as recorder:
+                for p_key in p_keys:
+                    try:
+                        api._takeSeat(p_key, conf)
+                        result = 'registered'
+                    except self.models.ConflictException:
+                        result = 'failed'
+                    except Exception as e:
+                        logging.warning('%s', e)
+                        result = 'errors'
+                    with lock:
+                        outcome[result] += 1
+            with lock:
+                outcome['commits'] += recorder.calls['datastore_v3.Commit']
+
+        threads = [threading.Thread(target=register,
+                                    args=(p_keys[i::args.threads],))
+                   for i in range(args.threads)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        outcome.update({
+            'threads': args.threads,
+            'users': users,
+            'elapsed_ms': round(elapsed * 1000, 3),
+            'registrations_per_s': round(outcome['registered'] / elapsed, 2),
+            'retried_commits': outcome['commits'] - outcome['registered'],
+            'seats_left': seats.getSeatsAvailable(conf),
+        })
+        self.results['contention'] = outcome
+
+    def benchMappers(self):
+        """Time converting 10,000 in-memory Conferences to forms."""
+        ndb, Conference = self.ndb, self.models.Conference
+        confs = []
+        for n in range(10000):
+            form = self.conferenceForm(n)
+            confs.append(Conference(
+                key=ndb.Key('Profile', email(n % 100), Conference, n + 1),
+                name=form.name, description=form.description, city=form.city,
+                topics=form.topics, maxAttendees=form.maxAttendees,
+                seatsAvailable=form.maxAttendees, organizerUserId=email(n % 100),
+                startDate=date(2016, 1, 1), endDate=date(2016, 1, 2), month=1))
+        results = {}
+        for name, mapper in (('toForms', self.mappers.CONFERENCE),
+                             ('toForms[SUMMARY]', self.mappers.SUMMARY)):
+            times, rpcs, errors = self.measure(
+                lambda i: mapper.toForms(confs), self.args.repeat)
+            results[name] = summarize(times, rpcs, errors)
+        times, rpcs, errors = self.measure(
+            lambda i: [self.mappers.CONFERENCE.toForm(c) for c in confs], self.args.repeat)
+        results['toForm'] = summarize(times, rpcs, errors)
+        self.results['mappers'] = results
+
+    def run(self):
+        self.results['params'] = dict((name, getattr(self.args, name)) for name in
+            ('users', 'conferences', 'sessions', 'wishlist', 'registrations',
+             'repeat', 'threads', 'per_thread', 'seed'))
+        self.populate()
+        self.benchApi()
+        self.benchHandlers()
+        self.benchContention()
+        self.benchMappers()
+        return self.results
+
+
+# - - - Baseline comparison - - - - - - - - - - - - - - - - - - - -
+
+def compare(results, baseline, tolerance):
+    """Return a list of regressions of `results` against `baseline`.
+
+    A benchmark regresses if its median time grew by more than `tolerance`
+    (a fraction) and NOISE_FLOOR_MS, or if it makes more RPCs.
+    """
+    regressions = []
+    for section in ('api', 'tasks', 'mappers'):
+        for name, current in sorted(results.get(section, {}).items()):
+            base = baseline.get(section, {}).get(name)
+            if not base:
+                continue
+            slower = current['median_ms'] - base['median_ms']
+            if (current['median_ms'] > base['median_ms'] * (1 + tolerance) and
+                    slower > NOISE_FLOOR_MS):
+                regressions.append('%s %s: median %.1f ms -> %.1f ms' % (
+                    section, name, base['median_ms'], current['median_ms']))
+            if current['rpcs'] > base['rpcs']:
+                regressions.append('%s %s: %.1f RPCs -> %.1f RPCs' % (
+                    section, name, base['rpcs'], current['rpcs']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+        help='path to the App Engine Python SDK (google_appengine)')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--conferences', type=int, default=200)
+    parser.add_argument('--sessions', type=int, default=5,
+        help='sessions per conference')
+    parser.add_argument('--wishlist', type=int, default=5,
+        help='wishlist entries per user')
+    parser.add_argument('--registrations', type=int, default=3,
+        help='conferences each user registers for')
+    parser.add_argument('--repeat', type=int, default=10,
+        help='calls per benchmark')
+    parser.add_argument('--threads', type=int, default=8,
+        help='concurrent registrants in the contention run')
+    parser.add_argument('--per-thread', dest='per_thread', type=int, default=25)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', default='bench.json')
+    parser.add_argument('--baseline', help='results of an earlier run to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+        help='allowed slowdown of a median, as a fraction')
+    args = parser.parse_args(argv)
+    if not args.sdk:
+        parser.error('--sdk or APPENGINE_SDK is required')
+
+    logging.basicConfig(level=logging.ERROR)
+    setupPaths(args.sdk)
+    args.bed = activateTestbed()
+    try:
+        results = Benchmark(args).run()
+    finally:
+        args.bed.deactivate()
+
+    with open(args.out, 'w') as out:
+        json.dump(results, out, indent=2, sort_keys=True)
+    print('wrote %s' % args.out)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION %s' % regression)
+        if regressions:
+            return 1
+        print('no regressions against %s' % args.baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
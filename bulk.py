@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+
+"""bulk.py -- streaming bulk import and export of conferences and sessions
+
+Rows are JSON lines or CSV (repeated fields joined with ';').
+
+Export writes one query page at a time and stops after a segment of rows,
+returning a cursor from which the next segment resumes.
+
+Import reads an uploaded blob from a byte offset stored on an ImportJob,
+writes one chunk of rows with put_multi (sessions together with their
+conference's timetable) and chains the next chunk as a task.  CSV is
+parsed as one stream, so quoted cells may span lines; the offset is only
+ever moved to a record boundary.  Rows without a websafeKey get a key
+derived from the job and the row's offset, so a retried chunk rewrites
+the same entities, and a failed job resumes from its last committed
+offset.
+
+"""
+
+import csv
+import json
+import logging
+from datetime import datetime
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
+
+from models import Conference
+from models import ImportJob
+from models import Profile
+from models import Session
+
+from conference import ConferenceApi
+import facets
+import querycache
+import seats
+import textindex
+import timetable
+
+EXPORT_PAGE_SIZE = 100
+EXPORT_SEGMENT_ROWS = 5000
+IMPORT_CHUNK_ROWS = 200
+LIST_SEPARATOR = ';'
+
+CONFERENCE_COLUMNS = ['websafeKey', 'organizerUserId', 'organizerDisplayName',
+                      'name', 'description',
+                      'topics', 'city', 'startDate', 'endDate',
+                      'maxAttendees', 'seatsAvailable']
+SESSION_COLUMNS = ['websafeKey', 'websafeConferenceKey', 'name', 'highlights',
+                   'speaker', 'duration', 'typeOfSession', 'date', 'startTime']
+
+KINDS = {
+    'conference': (Conference, CONFERENCE_COLUMNS),
+    'session': (Session, SESSION_COLUMNS),
+}
+FORMATS = ('jsonl', 'csv')
+
+
+class BulkError(Exception):
+    """Raised for a malformed request or row."""
+
+
+# - - - Rows - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def _toRow(entity, columns):
+    """Return an entity's columns as a dict of JSON-friendly values."""
+    row = {'websafeKey': entity.key.urlsafe()}
+    if isinstance(entity, Session):
+        row['websafeConferenceKey'] = entity.key.parent().urlsafe()
+    for name, value in entity.to_dict().items():
+        if name not in columns:
+            continue
+        if hasattr(value, 'strftime'):
+            value = value.strftime('%H:%M' if name == 'startTime' else '%Y-%m-%d')
+        row[name] = value
+    return row
+
+
+def _csvValue(value):
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        value = LIST_SEPARATOR.join(value)
+    return unicode(value).encode('utf-8')
+
+
+def _fromCsv(columns, values):
+    """Turn a CSV record into a row dict; empty cells are missing values."""
+    row = {}
+    for name, value in zip(columns, values):
+        value = value.decode('utf-8')
+        if not value:
+            continue
+        if name in ('topics', 'typeOfSession'):
+            value = value.split(LIST_SEPARATOR)
+        row[name] = value
+    return row
+
+
+def _int(row, name):
+    return int(row[name]) if row.get(name) not in (None, '') else None
+
+
+def _date(row, name):
+    value = row.get(name)
+    return datetime.strptime(value[:10], "%Y-%m-%d").date() if value else None
+
+
+def _importKey(model, parent, row, job_id, offset):
+    """Return the row's websafeKey, or a key derived from its position."""
+    if row.get('websafeKey'):
+        key = ndb.Key(urlsafe=row['websafeKey'])
+        if key.kind() != model._get_kind() or key.parent() != parent:
+            raise BulkError('websafeKey does not match the row')
+        return key
+    return ndb.Key(model, 'import-%d-%d' % (job_id, offset), parent=parent)
+
+
+def _conferenceEntities(row, job_id, offset):
+    """Return the Conference and seat shards described by a row."""
+    if not row.get('name') or not row.get('organizerUserId'):
+        raise BulkError("'name' and 'organizerUserId' are required")
+    p_key = ndb.Key(Profile, row['organizerUserId'])
+    conf = Conference(
+        key=_importKey(Conference, p_key, row, job_id, offset),
+        name=row['name'],
+        description=row.get('description'),
+        organizerUserId=row['organizerUserId'],
+        organizerDisplayName=row.get('organizerDisplayName'),
+        topics=row.get('topics') or [],
+        city=row.get('city'),
+        startDate=_date(row, 'startDate'),
+        endDate=_date(row, 'endDate'),
+        maxAttendees=_int(row, 'maxAttendees') or 0,
+    )
+    conf.month = conf.startDate.month if conf.startDate else 0
+    conf.seatsAvailable = _int(row, 'seatsAvailable')
+    if conf.seatsAvailable is None:
+        conf.seatsAvailable = conf.maxAttendees
+    return [conf] + seats.initSeats(conf, conf.seatsAvailable)
+
+
+def _sessionEntities(row, job_id, offset):
+    """Return the Session described by a row."""
+    if not row.get('name') or not row.get('websafeConferenceKey'):
+        raise BulkError("'name' and 'websafeConferenceKey' are required")
+    c_key = ndb.Key(urlsafe=row['websafeConferenceKey'])
+    if c_key.kind() != Conference._get_kind():
+        raise BulkError('websafeConferenceKey is not a conference key')
+    start_time = row.get('startTime')
+    return [Session(
+        key=_importKey(Session, c_key, row, job_id, offset),
+        name=row['name'],
+        highlights=row.get('highlights'),
+        speaker=row.get('speaker'),
+        duration=_int(row, 'duration'),
+        typeOfSession=row.get('typeOfSession') or [],
+        date=_date(row, 'date'),
+        startTime=datetime.strptime(start_time, "%H:%M").time() if start_time else None,
+    )]
+
+
+def _records(reader, fmt):
+    """Yield (offset, end, record) for each non-blank record from the
+    reader's position: a list of cells for CSV, a line for JSON lines.
+    offset and end are the byte positions where the record starts and
+    where the next one starts.
+
+    The CSV reader pulls one line at a time and never reads ahead of the
+    record it returns, so the reader's position after a record is that
+    record's end.
+    """
+    ends = [reader.tell()]
+
+    def lines():
+        while True:
+            line = reader.readline()
+            if not line:
+                return
+            ends[0] = reader.tell()
+            yield line
+
+    records = csv.reader(lines()) if fmt == 'csv' else lines()
+    offset = ends[0]
+    for record in records:
+        if any(cell.strip() for cell in record) if fmt == 'csv' else record.strip():
+            yield offset, ends[0], record
+        offset = ends[0]
+
+
+# - - - Export - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def exportRows(kind, fmt, out, cursor=None, limit=EXPORT_SEGMENT_ROWS):
+    """Write up to `limit` rows of a kind to `out`, one query page at a
+    time; return the cursor to resume from, or None when done.
+
+    A CSV header is written only at the start of the export.
+    """
+    if kind not in KINDS or fmt not in FORMATS:
+        raise BulkError('Unknown kind or format.')
+    model, columns = KINDS[kind]
+    writer = csv.writer(out) if fmt == 'csv' else None
+    if writer and not cursor:
+        writer.writerow(columns)
+
+    start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    written = 0
+    while written < limit:
+        entities, start_cursor, more = model.query().fetch_page(
+            min(EXPORT_PAGE_SIZE, limit - written), start_cursor=start_cursor)
+        # the seat counter, not the synced copy, is the current seat count
+        open_seats = seats.getSeatsAvailableMulti(entities) if model is Conference else {}
+        for entity in entities:
+            row = _toRow(entity, columns)
+            if entity.key in open_seats:
+                row['seatsAvailable'] = open_seats[entity.key]
+            if writer:
+                writer.writerow([_csvValue(row.get(name)) for name in columns])
+            else:
+                out.write(json.dumps(row) + '\n')
+        written += len(entities)
+        if not more or not start_cursor:
+            return None
+    return start_cursor.urlsafe()
+
+
+# - - - Import - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def startImport(blob_key, kind, fmt):
+    """Create an ImportJob for an uploaded blob and queue its first chunk."""
+    if kind not in KINDS or fmt not in FORMATS:
+        raise BulkError('Unknown kind or format.')
+    job = ImportJob(blobKey=blob_key, kind=kind, format=fmt)
+    job.put()
+    queueChunk(job)
+    return job
+
+
+def queueChunk(job):
+    """Queue the chunk starting at the job's current offset.
+
+    The task name makes enqueueing the same chunk twice a no-op.
+    """
+    try:
+        taskqueue.add(params={'job': job.key.id()},
+            name='import-%d-%d-%d' % (job.key.id(), job.offset, job.attempt),
+            url='/tasks/import_chunk')
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def resumeImport(job_id):
+    """Requeue a failed or stalled job from its last committed offset."""
+    job = ImportJob.get_by_id(job_id)
+    if not job or job.done:
+        return job
+    job.attempt += 1
+    job.error = None
+    job.put()
+    queueChunk(job)
+    return job
+
+
+def importChunk(job_id):
+    """Import up to IMPORT_CHUNK_ROWS rows from the job's offset, commit
+    the new offset and queue the next chunk if the blob is not exhausted.
+    """
+    job = ImportJob.get_by_id(job_id)
+    if not job or job.done:
+        return
+    build = _conferenceEntities if job.kind == 'conference' else _sessionEntities
+    reader = blobstore.BlobReader(job.blobKey, position=job.offset)
+    start = job.offset
+    header = list(job.header)
+    entities = []
+    offsets = []    # the offset of each entity's row
+    rows = 0
+    done = True
+    # offset is where the record being read starts, also while the CSV
+    # reader parses it
+    offset = end = start
+    try:
+        for offset, end, record in _records(reader, job.format):
+            if job.format == 'csv' and not header:
+                header = record
+            else:
+                row = _fromCsv(header, record) if job.format == 'csv' else json.loads(record)
+                built = build(row, job.key.id(), offset)
+                entities.extend(built)
+                offsets.extend([offset] * len(built))
+                rows += 1
+            offset = end
+            if rows >= IMPORT_CHUNK_ROWS:
+                done = False
+                break
+        if job.kind == 'session' and entities:
+            # sessions of a missing conference would be written as orphans
+            conf_keys = list(set(sesh.key.parent() for sesh in entities))
+            missing = set(key for key, conf in zip(conf_keys, ndb.get_multi(conf_keys))
+                          if not conf)
+            for offset, sesh in zip(offsets, entities):
+                if sesh.key.parent() in missing:
+                    raise BulkError('no conference with websafeConferenceKey %s'
+                                    % sesh.key.parent().urlsafe())
+    except (BulkError, ValueError, TypeError, csv.Error,
+            ProtocolBufferDecodeError) as e:
+        logging.error('import job %d failed at offset %d: %s', job_id, offset, e)
+        _fail(job_id, 'offset %d: %s' % (offset, e))
+        return
+
+    if job.kind == 'conference':
+        ndb.put_multi(entities)
+        conferences = [e for e in entities if isinstance(e, Conference)]
+        ConferenceApi._bumpConferenceVersions([conf.key for conf in conferences])
+        querycache.bumpGeneration()
+        if conferences:
+            ConferenceApi._noteSeats(conferences)
+            textindex.index(conferences)
+            # a chunk that is retried is counted again; the facet rebuild
+            # job corrects that
+            ndb.transaction(lambda: facets.adjust(
+                facets.changes(after=facets.facetValues(conferences))))
+    if entities and job.kind == 'session':
+        by_conference = {}
+        for sesh in entities:
+            by_conference.setdefault(sesh.key.parent(), []).append(sesh)
+        for conf_key, sessions in by_conference.items():
+            timetable.rebuild(conf_key, sessions)
+        taskqueue.add(params={'websafeSessionKey': [e.key.urlsafe() for e in entities]},
+            url='/tasks/set_featured_speaker')
+    job = _advance(job_id, start, end, header, rows, done)
+    if job and not done:
+        queueChunk(job)
+
+
+@ndb.transactional()
+def _advance(job_id, start, offset, header, rows, done):
+    """Move the job past a committed chunk; None if another run did."""
+    job = ImportJob.get_by_id(job_id)
+    if job.offset != start:
+        return None
+    job.offset = offset
+    job.header = header
+    job.rowsImported += rows
+    job.done = done
+    job.put()
+    return job
+
+
+@ndb.transactional()
+def _fail(job_id, error):
+    job = ImportJob.get_by_id(job_id)
+    job.error = error
+    job.put()
@@ -5,6 +5,8 @@ conference.py --  conference server-side Python App Engine API;
     uses Google Cloud Endpoints
 
 """
+import collections
+import hashlib
 import json
 import os
 import time
@@ -16,25 +18,40 @@ import time
 import endpoints
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
+from models import AnnouncementState
 from models import ConflictException
 from models import Profile
 from models import ProfileMiniForm
 from models import ProfileForm
+from models import ProfileForms
+from models import Registration
 from models import BooleanMessage
+from models import ConditionalRequest
 from models import Conference
 from models import ConferenceForm
+from models import ConferenceFacetForm
+from models import ConferenceFacetForms
 from models import ConferenceForms
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
+from models import ConferenceSearchForm
+from models import ConferenceView
+from models import FacetValueForm
+from models import QueryPlanForm
 from models import WishlistForm
 from models import WishlistForms
+from models import WishlistBatchForm
+from models import WishlistConflictForm
+from models import WishlistConflictForms
 from models import Wishlist
 from models import WishlistQuery
 from models import WishlistSpeakerQuery
@@ -45,20 +62,48 @@ from models import Session
 from models import SessionForm
 from models import SessionForms
 from models import SessionQuery
+from models import SessionQueryForms
 from models import SessionQueryType
 from models import SessionQuerySpeaker
+from models import SpeakerStats
 
 
 
 
 from utils import getUserId
+from utils import mapPage
+
+import facets
+import mappers
+import planner
+import querycache
+import rpcstats
+import schedule
+import seats
+import textindex
+import timetable
 
 from settings import WEB_CLIENT_ID
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+MEMCACHE_ANNOUNCEMENTS_KEY = "STAMPED_ANNOUNCEMENT"
+ANNOUNCEMENT_STATE_ID = "nearly_sold_out"
+# conferences with at most this many open seats are announced
+ANNOUNCEMENT_SEATS = 5
 MEMCACHE_SPEAKER_KEY = "FEATURED_SPEAKER"
+MEMCACHE_CONFERENCE_KEY = "CONFERENCE_FORM:%s"
+MEMCACHE_CONFERENCE_VERSION_KEY = "CONFERENCE_VERSION:%s"
+CONFERENCE_CACHE_TTL = 3600
+MEMCACHE_SUMMARY_KEY = "CONFERENCE_SUMMARY:%s"
+# the Conference properties listings need; everything but description
+SUMMARY_PROPERTIES = ('name', 'city', 'startDate', 'endDate', 'topics',
+                      'maxAttendees', 'organizerUserId', 'organizerDisplayName',
+                      'seatShards', 'seatsAvailable')
+REGISTRATION_RETRIES = 5
+MIGRATION_BATCH_SIZE = 100
+FANOUT_BATCH_SIZE = 100
+FEATURED_SPEAKER_TPL = 'Featured speaker: %s. Sessions: %s'
 ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
                     'are nearly sold out: %s')
 
@@ -87,6 +132,24 @@ FIELDS =    {
             'MAX_ATTENDEES': 'maxAttendees',
             }
 
+SESSION_OPERATORS = dict(OPERATORS, IN='IN', NOT_IN='NOT IN')
+
+SESSION_FIELDS = {
+            'TYPE': 'typeOfSession',
+            'START_TIME': 'startTime',
+            'DURATION': 'duration',
+            'DATE': 'date',
+            'SPEAKER': 'speaker',
+            }
+
+# rows querySessions may read for one page before returning a cursor
+SESSION_MAX_SCAN = 500
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+MAX_BATCH_SESSIONS = 500
+PUT_BATCH_SIZE = 100
+
 S_DEFAULTS = {
     "typeOfSession": ["Workshop", "Lecture"],
 }
@@ -96,11 +159,30 @@ CONF_GET_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_ETAG_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    etag=messages.StringField(2),
+)
+
 CONF_POST_REQUEST = endpoints.ResourceContainer(
     ConferenceForm,
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_PAGE_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1),
+    cursor=messages.StringField(2),
+    view=messages.EnumField(ConferenceView, 3),
+)
+
+CONF_LIST_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    view=messages.EnumField(ConferenceView, 1),
+    etag=messages.StringField(2),
+)
+
 
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -114,22 +196,103 @@ class ConferenceApi(remote.Service):
 
 # - - - Conference objects - - - - - - - - - - - - - - - - -
 
-    def _copyConferenceToForm(self, conf, displayName):
-        """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
-        if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
-        return cf
+    @staticmethod
+    @ndb.tasklet
+    def _organizerNamesAsync(conferences):
+        """Return {organizerUserId: displayName} for the conferences that
+        predate Conference.organizerDisplayName; others need no profile read.
+        """
+        organisers = list(set(ndb.Key(Profile, conf.organizerUserId)
+            for conf in conferences if not conf.organizerDisplayName))
+        profiles = yield ndb.get_multi_async(organisers)
+        raise ndb.Return(dict((prof.key.id(), prof.displayName)
+            for prof in profiles if prof))
+
+
+    @ndb.tasklet
+    def _copyConferencesToFormsAsync(self, conferences, mapper=mappers.CONFERENCE):
+        """Return ConferenceForms (or the mapper's forms) for conferences,
+        reading organizer names and seat counts in parallel."""
+        names, open_seats = yield rpcstats.gather(
+            lambda: self._organizerNamesAsync(conferences),
+            lambda: seats.getSeatsAvailableMultiAsync(conferences))
+        raise ndb.Return(mapper.toForms(conferences,
+            seatsAvailable=[open_seats[conf.key] for conf in conferences],
+            organizerDisplayName=[names.get(conf.organizerUserId) or
+                conf.organizerDisplayName for conf in conferences]))
+
+
+    def _copyConferencesToForms(self, conferences, mapper=mappers.CONFERENCE):
+        """Return ConferenceForms (or the mapper's forms) for conferences."""
+        return self._copyConferencesToFormsAsync(conferences, mapper).get_result()
+
+
+    @ndb.tasklet
+    def _conferenceSummariesAsync(self, conf_keys):
+        """Return partial Conferences holding only SUMMARY_PROPERTIES.
+
+        Each is read from a memcache copy stamped with the conference's
+        version, as in getConference, so a listing page costs one batched
+        memcache get; only misses read the full entities.  The partial
+        entities are for display and must never be put.
+        """
+        ctx = ndb.get_context()
+        wscks = [key.urlsafe() for key in conf_keys]
+        cached = yield ([ctx.memcache_get(MEMCACHE_SUMMARY_KEY % w) for w in wscks] +
+            [ctx.memcache_get(MEMCACHE_CONFERENCE_VERSION_KEY % w) for w in wscks])
+        entries = dict(zip(conf_keys, cached[:len(conf_keys)]))
+        versions = dict(zip(conf_keys, cached[len(conf_keys):]))
+
+        summaries = {}
+        for key in conf_keys:
+            entry = entries[key]
+            if entry and versions[key] is not None and entry[0] == versions[key]:
+                summaries[key] = Conference(key=key, **entry[1])
+
+        missing = [key for key in conf_keys if key not in summaries]
+        if missing:
+            stamps = yield self._stampConferencesAsync(
+                [key for key in missing if versions[key] is None])
+            versions.update(stamps)
+            conferences = yield ndb.get_multi_async(missing)
+            to_cache = []
+            for conf in conferences:
+                if not conf:
+                    continue
+                values = dict((name, getattr(conf, name)) for name in SUMMARY_PROPERTIES)
+                summaries[conf.key] = Conference(key=conf.key, **values)
+                # seats of unsharded conferences come from the entity, so
+                # those are not cached until ensureSeats() shards them
+                if conf.seatShards and versions[conf.key] is not None:
+                    to_cache.append(ctx.memcache_set(
+                        MEMCACHE_SUMMARY_KEY % conf.key.urlsafe(),
+                        (versions[conf.key], values), time=CONFERENCE_CACHE_TTL))
+            yield to_cache
+
+        raise ndb.Return([summaries[key] for key in conf_keys if key in summaries])
+
+
+    @ndb.tasklet
+    def _listConferencesAsync(self, view, conf_keys=None, conferences=None):
+        """Return ConferenceForms listing conferences, given either their
+        keys or the entities.
+
+        The SUMMARY view fills summaries with ConferenceSummaryForms, built
+        from the summary cache when only keys are given; otherwise items
+        holds full ConferenceForms.
+        """
+        summary = view == ConferenceView.SUMMARY
+        if conferences is None:
+            if summary:
+                conferences = yield self._conferenceSummariesAsync(conf_keys)
+            else:
+                conferences = yield ndb.get_multi_async(conf_keys)
+                conferences = [conf for conf in conferences if conf]
+        if summary:
+            forms = yield self._copyConferencesToFormsAsync(conferences, mappers.SUMMARY)
+            raise ndb.Return(ConferenceForms(summaries=forms))
+        forms = yield self._copyConferencesToFormsAsync(conferences)
+        raise ndb.Return(ConferenceForms(items=forms))
 
 
     def _createConferenceObject(self, request):
@@ -145,8 +308,7 @@ class ConferenceApi(remote.Service):
 
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
-        del data['websafeKey']
-        del data['organizerDisplayName']
+        del data['websafeKey'], data['etag'], data['notModified']
 
         # add default values for those missing (both data model & outbound Message)
         for df in DEFAULTS:
@@ -167,35 +329,78 @@ class ConferenceApi(remote.Service):
         if data["maxAttendees"] > 0:
             data["seatsAvailable"] = data["maxAttendees"]
         # generate Profile Key based on user ID and Conference
-        # ID based on Profile key get Conference key from ID
+        # ID based on Profile key get Conference key from ID; the Profile
+        # (for the organizer's name, so listings need no Profile reads) is
+        # loaded at the same time
         p_key = ndb.Key(Profile, user_id)
-        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
+        prof, (c_id, _) = rpcstats.gather(
+            lambda: self._getProfileFromUserAsync(),
+            lambda: Conference.allocate_ids_async(size=1, parent=p_key)).get_result()
         c_key = ndb.Key(Conference, c_id, parent=p_key)
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
+        data['organizerDisplayName'] = request.organizerDisplayName = prof.displayName
 
-        # create Conference, send email to organizer confirming
-        # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
+        # create Conference and its seat counter shards, send email to
+        # organizer confirming creation of Conference & return (modified)
+        # ConferenceForm
+        conf = Conference(**data)
+        seat_shards = seats.initSeats(conf, data["seatsAvailable"])
         # TODO 2: add confirmation email sending task to queue
-        taskqueue.add(params={'email': user.email(),
+        task = taskqueue.Task(params={'email': user.email(),
             'conferenceInfo': repr(request)},
             url='/tasks/send_confirmation_email'
         )
+        rpcstats.gather(
+            lambda: ndb.put_multi_async(seat_shards),
+            lambda: self._insertConferenceAsync(conf),
+            lambda: self._addTaskAsync(task)).get_result()
+        querycache.bumpGeneration()
+        if 0 < data["seatsAvailable"] <= ANNOUNCEMENT_SEATS:
+            self._noteSeats([conf])
 
         return request
 
 
-    @ndb.transactional()
+    @staticmethod
+    @ndb.tasklet
+    def _addTaskAsync(task):
+        """Enqueue a task; return an ndb future for it.
+
+        Queue.add_async() returns a UserRPC, which a tasklet may wait on
+        alone but which cannot be combined with futures in a list.
+        """
+        result = yield taskqueue.Queue().add_async(task)
+        raise ndb.Return(result)
+
+
+    @staticmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _insertConferenceAsync(conf):
+        """Put a new Conference, count it in the facet counters and queue
+        its indexing for search, in one transaction."""
+        yield [conf.put_async(),
+               facets.adjustAsync(facets.changes(after=facets.facetValues([conf]))),
+               textindex.queueIndexAsync([conf.key])]
+
+
     def _updateConferenceObject(self, request):
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
         user_id = getUserId(user)
 
-        # copy ConferenceForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
+        conf = ndb.transaction(lambda: self._applyConferenceUpdate(request, user_id),
+            xg=True)
+        self._bumpConferenceVersions([conf.key])
+        querycache.bumpGeneration()
+        # the name or the number of seats may have changed
+        self._noteSeats([conf])
+        return self._copyConferencesToForms([conf])[0]
 
+
+    def _applyConferenceUpdate(self, request, user_id):
+        """Copy the supplied fields onto the Conference; run in a transaction."""
         # update existing conference
         conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
         # check that conference exists
@@ -207,27 +412,42 @@ class ConferenceApi(remote.Service):
         if user_id != conf.organizerUserId:
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
+        before = facets.facetValues([conf])
 
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
             data = getattr(request, field.name)
-            # only copy fields where we get data
-            if data not in (None, []):
+            # only copy fields where we get data; seatsAvailable is derived
+            # from the seat counter and the organizer fields from the owner's
+            # Profile, so they are never written directly
+            if data not in (None, []) and field.name not in (
+                    'seatsAvailable', 'organizerUserId', 'organizerDisplayName',
+                    'etag', 'notModified'):
                 # special handling for dates (convert string to Date)
                 if field.name in ('startDate', 'endDate'):
                     data = datetime.strptime(data, "%Y-%m-%d").date()
                     if field.name == 'startDate':
                         conf.month = data.month
+                # grow or shrink the seat pool along with maxAttendees
+                if field.name == 'maxAttendees':
+                    delta = data - (conf.maxAttendees or 0)
+                    if conf.seatShards:
+                        seats.adjustSeats(conf, delta)
+                    else:
+                        conf.seatsAvailable = (conf.seatsAvailable or 0) + delta
                 # write to Conference object
                 setattr(conf, field.name, data)
         conf.put()
-        prof = ndb.Key(Profile, user_id).get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        facets.adjust(facets.changes(before, facets.facetValues([conf])))
+        if request.name is not None or request.description is not None:
+            textindex.queueIndex([conf.key])
+        return conf
 
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
             http_method='POST', name='createConference')
+    @rpcstats.measured
     def createConference(self, request):
         """Create new conference."""
         return self._createConferenceObject(request)
@@ -236,31 +456,113 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_POST_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='PUT', name='updateConference')
+    @rpcstats.measured
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
         return self._updateConferenceObject(request)
 
 
-    @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
+    @endpoints.method(CONF_ETAG_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='GET', name='getConference')
+    @rpcstats.measured
     def getConference(self, request):
-        """Return requested conference (by websafeConferenceKey)."""
+        """Return requested conference (by websafeConferenceKey).
+
+        Read through a memcache copy of the ConferenceForm, valid while its
+        version stamp matches the conference's current version; a hit costs
+        a single memcache get_multi.  The ETag is derived from the version
+        stamp, so a client holding the current copy gets back only
+        notModified.
+        """
+        wsck = request.websafeConferenceKey
+        form_key = MEMCACHE_CONFERENCE_KEY % wsck
+        version_key = MEMCACHE_CONFERENCE_VERSION_KEY % wsck
+        cached = memcache.get_multi([form_key, version_key])
+        version = cached.get(version_key)
+        if version is None:
+            memcache.add(version_key, int(time.time() * 1000))
+            version = memcache.get(version_key)
+        etag = self._etag('conference', wsck, version) if version is not None else None
+        if etag and request.etag == etag:
+            return ConferenceForm(etag=etag, notModified=True)
+        if form_key in cached and cached[form_key][0] == version:
+            cf = protojson.decode_message(ConferenceForm, cached[form_key][1])
+            cf.etag = etag
+            return cf
+
         # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = ndb.Key(urlsafe=wsck).get()
         if not conf:
             raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
+                'No conference found with key: %s' % wsck)
+        cf = self._copyConferencesToForms([conf])[0]
+        # stamped with the version read before the datastore, so a write
+        # racing with this read leaves an entry that no longer matches
+        memcache.set(form_key, (version, protojson.encode_message(cf)),
+            time=CONFERENCE_CACHE_TTL)
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        cf.etag = etag
+        return cf
+
+
+    @staticmethod
+    def _etag(*stamps):
+        """Return the ETag of a response built from data with the given
+        version stamps; the payload itself is never serialized for it."""
+        return hashlib.sha1(repr(stamps)).hexdigest()
+
+
+    @staticmethod
+    @ndb.tasklet
+    def _conferenceVersionsAsync(conf_keys):
+        """Return {conference key: version stamp}, stamping conferences
+        that have no stamp in memcache yet; a stamp is None only when
+        memcache is unavailable."""
+        ctx = ndb.get_context()
+        stamps = yield [ctx.memcache_get(MEMCACHE_CONFERENCE_VERSION_KEY % key.urlsafe())
+            for key in conf_keys]
+        versions = dict(zip(conf_keys, stamps))
+        stamps = yield ConferenceApi._stampConferencesAsync(
+            [key for key in conf_keys if versions[key] is None])
+        versions.update(stamps)
+        raise ndb.Return(versions)
 
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @staticmethod
+    @ndb.tasklet
+    def _stampConferencesAsync(conf_keys):
+        """Give conferences without a version stamp in memcache one;
+        return {conference key: version stamp}."""
+        if not conf_keys:
+            raise ndb.Return({})
+        ctx = ndb.get_context()
+        now = int(time.time() * 1000)
+        yield [ctx.memcache_add(MEMCACHE_CONFERENCE_VERSION_KEY % key.urlsafe(), now)
+            for key in conf_keys]
+        stamps = yield [ctx.memcache_get(MEMCACHE_CONFERENCE_VERSION_KEY % key.urlsafe())
+            for key in conf_keys]
+        raise ndb.Return(dict(zip(conf_keys, stamps)))
+
+
+    @staticmethod
+    def _bumpConferenceVersions(conf_keys):
+        """Invalidate the cached ConferenceForms of the given conferences."""
+        if conf_keys:
+            memcache.offset_multi(dict((MEMCACHE_CONFERENCE_VERSION_KEY % key.urlsafe(), 1)
+                for key in conf_keys), initial_value=int(time.time() * 1000))
+
+
+    @endpoints.method(CONF_PAGE_REQUEST, ConferenceForms,
             path='getConferencesCreated',
             http_method='POST', name='getConferencesCreated')
+    @rpcstats.measured
     def getConferencesCreated(self, request):
-        """Return conferences created by user."""
+        """Return conferences created by user, one page at a time.
+
+        With view=SUMMARY only keys are queried and the listing is built
+        from cached summaries.
+        """
         # make sure user is authed
         user = endpoints.get_current_user()
         if not user:
@@ -268,37 +570,63 @@ class ConferenceApi(remote.Service):
         user_id =  getUserId(user)
         # create ancestor query for all key matches for this user
         confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        if request.view == ConferenceView.SUMMARY:
+            keys, next_cursor, more = self._fetchPage(confs, request, keys_only=True)
+            forms = self._listConferencesAsync(request.view, conf_keys=keys)
+        else:
+            confs, next_cursor, more = self._fetchPage(confs, request)
+            forms = self._listConferencesAsync(request.view, conferences=confs)
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
-        )
+        forms = forms.get_result()
+        forms.nextCursor = next_cursor
+        forms.more = more
+        return forms
 
 
-    def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
-        q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
+    def _pageSize(self, request):
+        """Return the request's pageSize, checking it is within bounds."""
+        page_size = request.pageSize or DEFAULT_PAGE_SIZE
+        if page_size < 1 or page_size > MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                'pageSize must be between 1 and %d.' % MAX_PAGE_SIZE)
+        return page_size
 
-        # If exists, sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Conference.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
 
-        for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
-            formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
-            q = q.filter(formatted_query)
-        return q
+    def _fetchPage(self, query, request, keys_only=False):
+        """Fetch one page of query results using the request's pageSize
+        and opaque cursor; return (entities, nextCursor, more).
+        """
+        page_size = self._pageSize(request)
+        try:
+            start_cursor = ndb.Cursor(urlsafe=request.cursor) if request.cursor else None
+            entities, next_cursor, more = query.fetch_page(page_size,
+                start_cursor=start_cursor, keys_only=keys_only)
+        except (datastore_errors.BadValueError, datastore_errors.BadRequestError):
+            raise endpoints.BadRequestException('Invalid cursor.')
+        next_cursor = next_cursor.urlsafe() if (more and next_cursor) else None
+        return entities, next_cursor, bool(more)
+
+
+    def _getQuery(self, request, filters=None):
+        """Return the query plan for the submitted filters.
+
+        The planner pushes the most selective filter to the datastore and
+        evaluates the others in memory, so any mix of inequalities works
+        with only the single-property indexes in index.yaml.  A request
+        continuing from a cursor keeps the plan of its first page.
+        """
+        if filters is None:
+            filters = self._formatFilters(request.filters)
+        try:
+            return planner.plan(Conference, filters,
+                planner.getStats('Conference'), cursor=request.cursor)
+        except planner.InvalidCursor:
+            raise endpoints.BadRequestException('Invalid cursor.')
 
 
     def _formatFilters(self, filters):
         """Parse, check validity and format user supplied filters."""
         formatted_filters = []
-        inequality_field = None
 
         for f in filters:
             filtr = {field.name: getattr(f, field.name) for field in f.all_fields()}
@@ -309,75 +637,151 @@ class ConferenceApi(remote.Service):
             except KeyError:
                 raise endpoints.BadRequestException("Filter contains invalid field or operator.")
 
-            # Every operation except "=" is an inequality
-            if filtr["operator"] != "=":
-                # check if inequality operation has been used in previous filters
-                # disallow the filter if inequality was performed on a different field before
-                # track the field on which the inequality operation is performed
-                if inequality_field and inequality_field != filtr["field"]:
-                    raise endpoints.BadRequestException("Inequality filter is allowed on only one field.")
-                else:
-                    inequality_field = filtr["field"]
+            if filtr["field"] in ["month", "maxAttendees"]:
+                try:
+                    filtr["value"] = int(filtr["value"])
+                except (TypeError, ValueError):
+                    raise endpoints.BadRequestException(
+                        "Filter on %s requires an integer value." % filtr["field"])
 
             formatted_filters.append(filtr)
-        return (inequality_field, formatted_filters)
+        return formatted_filters
 
 
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
             path='queryConferences',
             http_method='POST',
             name='queryConferences')
+    @rpcstats.measured
     def queryConferences(self, request):
-        """Query for conferences."""
-        conferences = self._getQuery(request)
-
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
-
-        # return individual ConferenceForm object per Conference
-        return ConferenceForms(
-                items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in \
-                conferences]
-        )
-
+        """Query for conferences, one page at a time.
 
-# - - - Session objects - - - - - - - - - - - - - - - - -
-    def _transferSessionToForm(self, sesh):
-        """get fields required into SessionForm from Session"""
-        seshForm = SessionForm()
+        With explain set, the response also describes the chosen plan and
+        how many rows were scanned to produce the page.  With view=SUMMARY
+        and no filters left to evaluate in memory, only keys are queried
+        and the listing is built from cached summaries.
 
-        for field in seshForm.all_fields():
-            if hasattr(sesh, field.name):
-                if field.name.endswith('date') or field.name.endswith('Time'):
-                    setattr(seshForm, field.name, str(getattr(sesh, field.name)))
-                else:
-                    setattr(seshForm, field.name, getattr(sesh, field.name))
-        seshForm.check_initialized()
+        Other pages are served from the query cache while no conference
+        has been written since they were cached; only their open seats are
+        read again.
+        """
+        filters = self._formatFilters(request.filters)
+        page_size = self._pageSize(request)
+        miss = None
+        if not request.explain:
+            query_hash = querycache.queryHash(
+                sorted((f['field'], f['operator'], f['value']) for f in filters),
+                page_size, request.cursor, str(request.view))
+            cached, miss = querycache.get(query_hash)
+            if cached:
+                return self._cachedConferenceForms(*cached)
+
+        plan = self._getQuery(request, filters)
+        keys_only = request.view == ConferenceView.SUMMARY and not plan.residual
+        try:
+            conferences, next_cursor, more, scanned = plan.execute(
+                page_size, request.cursor, keys_only=keys_only)
+        except planner.InvalidCursor:
+            raise endpoints.BadRequestException('Invalid cursor.')
+
+        # organiser displayName is stored on the Conference (only older
+        # conferences need their organiser's profile)
+        returned = len(conferences)
+        if keys_only:
+            conferences = self._conferenceSummariesAsync(conferences).get_result()
+        forms = self._listConferencesAsync(request.view,
+            conferences=conferences).get_result()
+        forms.nextCursor = next_cursor
+        forms.more = more
+        if request.explain:
+            forms.plan = self._planForm(plan, scanned, returned)
+        if miss:
+            querycache.put(miss, (protojson.encode_message(forms),
+                [(conf.seatShards or 0, conf.seatsAvailable or 0) for conf in conferences]))
+        return forms
+
+
+    def _cachedConferenceForms(self, encoded, seat_rows):
+        """Decode a cached queryConferences page and fill in the current
+        open seats, given each row's (seatShards, seatsAvailable)."""
+        forms = protojson.decode_message(ConferenceForms, encoded)
+        rows = forms.items or forms.summaries
+        confs = [Conference(key=ndb.Key(urlsafe=form.websafeKey), seatShards=shards,
+                            seatsAvailable=available)
+                 for form, (shards, available) in zip(rows, seat_rows)]
+        open_seats = seats.getSeatsAvailableMulti(confs)
+        for form, conf in zip(rows, confs):
+            form.seatsAvailable = open_seats[conf.key]
+        return forms
+
+
+    @endpoints.method(message_types.VoidMessage, ConferenceFacetForms,
+            path='conferenceFacets',
+            http_method='GET', name='getConferenceFacets')
+    @rpcstats.measured
+    def getConferenceFacets(self, request):
+        """Return the number of conferences per city, topic, start month
+        and maxAttendees range, most common first.
+
+        Counts come from the sharded facet counters, usually a single
+        memcache get.
+        """
+        counts = facets.getFacets()
+        return ConferenceFacetForms(items=[ConferenceFacetForm(field=field,
+            values=[FacetValueForm(value=value, count=count) for value, count in
+                    sorted(counts.get(FIELDS[field], {}).items(),
+                           key=lambda item: (-item[1], item[0]))
+                    if count > 0])
+            for field in sorted(FIELDS)])
 
-        return seshForm
 
-    def _createSessionObject(self, request):
-        """Create Session object, returning SessionForm/request."""
-        # check auth
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+    @endpoints.method(ConferenceSearchForm, ConferenceForms,
+            path='searchConferences',
+            http_method='POST',
+            name='searchConferences')
+    @rpcstats.measured
+    def searchConferences(self, request):
+        """Search conference names and descriptions for all the words of
+        the query, best matches first, one page at a time."""
+        if not request.query:
+            raise endpoints.BadRequestException("'query' field required")
+        page_size = self._pageSize(request)
+        try:
+            offset = int(request.cursor) if request.cursor else 0
+        except ValueError:
+            offset = -1
+        if offset < 0:
+            raise endpoints.BadRequestException('Invalid cursor.')
+
+        # the ranked matches are all known, so the cursor is an offset
+        conf_keys = textindex.search(request.query)
+        forms = self._listConferencesAsync(request.view,
+            conf_keys=conf_keys[offset:offset + page_size]).get_result()
+        forms.more = offset + page_size < len(conf_keys)
+        forms.nextCursor = str(offset + page_size) if forms.more else None
+        return forms
+
+
+    def _planForm(self, plan, scanned, returned):
+        """Describe an executed query plan as a QueryPlanForm."""
+        pushed, residual, order = plan.explain()
+        return QueryPlanForm(pushedFilters=pushed, residualFilters=residual,
+            order=order, scanned=scanned, returned=returned)
 
-        # copy SessionForm into dict
-        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
-        user_id = getUserId(user)
-        conf = ndb.Key(urlsafe=data['confwebsafeKey']).get()
 
+# - - - Session objects - - - - - - - - - - - - - - - - -
+    def _sessionData(self, request, user):
+        """Validate a SessionForm and return its Session properties as a
+        dict; defaults are filled into both the dict and the form."""
         if not request.name:
             raise endpoints.BadRequestException("Session 'name' field required")
+        if not request.confwebsafeKey:
+            raise endpoints.BadRequestException("Session 'confwebsafeKey' field required")
 
+        # copy SessionForm into dict
+        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
+        del data['confwebsafeKey']
+        del data['websafeKey']
 
         # add default values for those missing (both data model & outbound Message)
         for df in S_DEFAULTS:
@@ -391,38 +795,110 @@ class ConferenceApi(remote.Service):
         if data['date']:
             data['date'] = datetime.strptime(data['date'][:10], "%Y-%m-%d").date()
 
+        if not data['speaker']:
+            data['speaker'] = request.speaker = user.nickname()
+        return data
+
+
+    def _createSessionObject(self, request):
+        """Create Session object, returning SessionForm/request."""
+        # check auth
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+
+        data = self._sessionData(request, user)
+        conf = ndb.Key(urlsafe=request.confwebsafeKey).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.confwebsafeKey)
+
         # generate session key from conference key
         p_key = conf.key
         c_id = Session.allocate_ids(size=1, parent=p_key)[0]
         c_key = ndb.Key(Session, c_id, parent=p_key)
         data['key'] = c_key
-        if not data['speaker']:
-            data['speaker'] = user.nickname()
-        del data['confwebsafeKey']
+        request.websafeKey = c_key.urlsafe()
 
-        # if speaker has more than 1 session, add to  memcache
-        sessions = Session.query(Session.speaker == data['speaker'],
-            ancestor=p_key)
-        if len(list(sessions)) > 1:
-            cache_data = {}
-            cache_data['speaker'] = data['speaker']
-            cache_data['sessionNames'] = [session.name for session in sessions]
-            if not memcache.set('featured_speaker', cache_data):
-                logging.error('Memcache set failed.')
+        timetable.rebuild(p_key, [Session(**data)])
+
+        # update the speaker's stats and the featured speaker off the
+        # request path
+        taskqueue.add(params={'websafeSessionKey': c_key.urlsafe()},
+            url='/tasks/set_featured_speaker'
+        )
+
+        return request
+
+
+    def _createSessionObjects(self, request):
+        """Create the Sessions of a SessionForms batch, returning it.
+
+        All forms are validated before anything is written; IDs are
+        reserved with one allocate_ids() per conference, sessions are
+        written with put_multi in chunks and the featured speaker is
+        recomputed by a single task for the whole batch.  Each chunk is
+        written in the transaction that rebuilds its conference's
+        timetable.
+        """
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        if len(request.items) > MAX_BATCH_SESSIONS:
+            raise endpoints.BadRequestException(
+                'At most %d sessions can be created at once.' % MAX_BATCH_SESSIONS)
+
+        # validate everything in one pass, grouping sessions by conference
+        batches = {}
+        for form in request.items:
+            data = self._sessionData(form, user)
+            batches.setdefault(ndb.Key(urlsafe=form.confwebsafeKey), []).append((form, data))
+        conf_keys = batches.keys()
+        for conf_key, conf in zip(conf_keys, ndb.get_multi(conf_keys)):
+            if not conf:
+                raise endpoints.NotFoundException(
+                    'No conference found with key: %s' % conf_key.urlsafe())
+
+        sessions = []
+        for conf_key in conf_keys:
+            batch = batches[conf_key]
+            first, last = Session.allocate_ids(size=len(batch), parent=conf_key)
+            conf_sessions = []
+            for s_id, (form, data) in zip(range(first, last + 1), batch):
+                sesh = Session(key=ndb.Key(Session, s_id, parent=conf_key), **data)
+                form.websafeKey = sesh.key.urlsafe()
+                conf_sessions.append(sesh)
+            for i in range(0, len(conf_sessions), PUT_BATCH_SIZE):
+                timetable.rebuild(conf_key, conf_sessions[i:i + PUT_BATCH_SIZE])
+            sessions.extend(conf_sessions)
+
+        if sessions:
+            taskqueue.add(params={'websafeSessionKey': [sesh.key.urlsafe() for sesh in sessions]},
+                url='/tasks/set_featured_speaker'
+            )
 
         return request
 
 # - - - Sessions - - - - - - - - - - - - - - - - - - - -
     @endpoints.method(SessionForm, SessionForm, path='session',
             http_method='POST', name='createSession')
+    @rpcstats.measured
     def createSession(self, request):
         """Create new session. open only to the organizer of the conference"""
         return self._createSessionObject(request)
 
+    @endpoints.method(SessionForms, SessionForms, path='sessions',
+            http_method='POST', name='createSessions')
+    @rpcstats.measured
+    def createSessions(self, request):
+        """Create many sessions at once, e.g. a whole conference programme."""
+        return self._createSessionObjects(request)
+
     @endpoints.method(endpoints.ResourceContainer(
         speaker=messages.StringField(1)), SessionForms,
             path='session/{speaker}',
             http_method='GET', name='getSessionsBySpeaker')
+    @rpcstats.measured
     def getSessionsBySpeaker(self, request):
         """Given a speaker, return all sessions given by this particular speaker, across all conferences"""
         # query session
@@ -432,12 +908,13 @@ class ConferenceApi(remote.Service):
         q = Session.query(Session.speaker == request.speaker)
 
         return SessionForms(
-            items=[self._transferSessionToForm(sesh) for sesh in q]
+            items=mappers.SESSION.toForms(q)
         )
 
 
     @endpoints.method(SessionQueryType, SessionForms, path='queryType',
             http_method='GET', name='getConferenceSessionsByType')
+    @rpcstats.measured
     def getConferenceSessionsByType(self, request):
         """Get session by typeOfSession."""
         if not request.websafeConferenceKey:
@@ -446,89 +923,297 @@ class ConferenceApi(remote.Service):
         if not request.typeOfSession:
             raise endpoints.ForbiddenException('typeOfSession is required.')
 
-        #parent key
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-
-        # filter by typeOfSession after querying session by ancestor
-        q = Session.query(ancestor=conf.key).filter(Session.typeOfSession == request.typeOfSession)
-
-        return SessionForms(items=[self._transferSessionToForm(sesh) for sesh in q])
+        # filter the conference's timetable by typeOfSession
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        table = self._getTimetable(c_key)
+        return SessionForms(items=timetable.toForms(c_key,
+            timetable.withType(table, request.typeOfSession)))
 
     @endpoints.method(SessionQuery, SessionForms, path="sessionQuery",
             http_method="GET", name="getConferenceSessions")
+    @rpcstats.measured
     def getConferenceSessions(self, request):
         """Returns sessions of a given conference"""
         if not request.websafeConferenceKey:
             raise endpoints.ForbiddenException("websafeConferenceKey is required.")
 
-        #parent key
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        # sessions in date and start time order, from the timetable
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        table = self._getTimetable(c_key)
+        return SessionForms(items=timetable.toForms(c_key, table['rows']))
+
+
+    def _getTimetable(self, c_key):
+        """Return a conference's timetable; bail if there is no conference."""
+        table = timetable.get(c_key)
+        if table is None:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % c_key.urlsafe())
+        return table
+
 
-        #ancestral session query
-        q = Session.query(ancestor=conf.key).fetch()
-        return SessionForms(items=[self._transferSessionToForm(sesh) for sesh in q])
+    def _formatSessionFilters(self, filters):
+        """Parse, check validity and format user supplied session filters.
+
+        Values are converted to the property's type; IN and NOT_IN take a
+        comma separated list, and an IN with one value is an equality.
+        """
+        formatted_filters = []
+        for f in filters:
+            try:
+                field = SESSION_FIELDS[f.field]
+                operator = SESSION_OPERATORS[f.operator]
+            except KeyError:
+                raise endpoints.BadRequestException("Filter contains invalid field or operator.")
+            if operator in ('IN', 'NOT IN'):
+                value = [self._sessionFilterValue(field, v.strip())
+                         for v in (f.value or '').split(',') if v.strip()]
+                if not value:
+                    raise endpoints.BadRequestException(
+                        "Filter on %s requires at least one value." % field)
+                if operator == 'IN' and len(value) == 1:
+                    operator, value = '=', value[0]
+            else:
+                value = self._sessionFilterValue(field, f.value)
+            formatted_filters.append({'field': field, 'operator': operator, 'value': value})
+        return formatted_filters
+
+
+    def _sessionFilterValue(self, field, value):
+        """Convert a filter value to the type of a Session property."""
+        try:
+            if field == 'startTime':
+                return datetime.strptime(value[:5], "%H:%M").time()
+            if field == 'date':
+                return datetime.strptime(value[:10], "%Y-%m-%d").date()
+            if field == 'duration':
+                return int(value)
+        except (TypeError, ValueError):
+            raise endpoints.BadRequestException(
+                "Invalid value for %s: %s" % (field, value))
+        if not value:
+            raise endpoints.BadRequestException("Filter on %s requires a value." % field)
+        return value
+
+
+    @endpoints.method(SessionQueryForms, SessionForms, path='querySessions',
+            http_method='POST', name='querySessions')
+    @rpcstats.measured
+    def querySessions(self, request):
+        """Query sessions, of one conference or of all, one page at a time.
+
+        The most selective filter is pushed to the datastore and the rest
+        are evaluated on the streamed results.  At most SESSION_MAX_SCAN
+        rows are read per request; a page cut short by the cap comes back
+        with a cursor to continue from.
+        """
+        filters = self._formatSessionFilters(request.filters)
+        ancestor = None
+        if request.websafeConferenceKey:
+            ancestor = ndb.Key(urlsafe=request.websafeConferenceKey)
+        try:
+            plan = planner.plan(Session, filters, planner.getStats('Session'),
+                order=(), cursor=request.cursor)
+            sessions, next_cursor, more, scanned = plan.execute(
+                self._pageSize(request), request.cursor, ancestor=ancestor,
+                max_scan=SESSION_MAX_SCAN)
+        except planner.InvalidCursor:
+            raise endpoints.BadRequestException('Invalid cursor.')
+
+        forms = SessionForms(items=mappers.SESSION.toForms(sessions),
+            nextCursor=next_cursor, more=more)
+        if request.explain:
+            forms.plan = self._planForm(plan, scanned, len(sessions))
+        return forms
 
 
 #----------Wish List object---------------------------------------
 
-    def _copyWishlistToForm(self, wish):
-        """Copy relevant fields from Wishlist to WishlistForm."""
-        wishForm = WishlistForm()
-        wishForm.sessionName = wish.sessionName
-        wishForm.sessionKey = str(wish.sessionKey)
-        wishFormtypeOfSession = wish.typeOfSession
-        wishForm.check_initialized()
-        return wishForm
+    @staticmethod
+    def _wishlistKey(user_id, session_key):
+        """Return the key of a user's Wishlist entry for a session.
+
+        Entries are children of the user's Profile, so a user's wishlist is
+        one entity group and can be read with a strongly consistent
+        ancestor query.
+        """
+        return ndb.Key(Wishlist, session_key.urlsafe(), parent=ndb.Key(Profile, user_id))
+
+
+    def _getWishlistSession(self, request):
+        """Return the Session named by the request's websafeSessionKey.
+
+        Requests that only carry a sessionName fall back to looking the
+        session up by name.
+        """
+        if request.websafeSessionKey:
+            s_key = ndb.Key(urlsafe=request.websafeSessionKey)
+            this_session = s_key.get() if s_key.kind() == 'Session' else None
+        elif request.sessionName:
+            this_session = Session.query(Session.name == request.sessionName).get()
+        else:
+            raise endpoints.BadRequestException('websafeSessionKey required')
+        if not this_session:
+            raise endpoints.NotFoundException('No session found')
+        return this_session
+
 
     def _createWishlistObject(self, request):
-        """Create or update Wishlist object, returning WishlistForm/request."""
+        """Create Wishlist object, returning WishlistForm/request."""
 
         # check auth
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
-        # check sessionName exists
-        if not request.sessionName:
-            raise endpoints.UnauthorizedException('Name required')
         # get userId
         user_id = getUserId(user)
 
-        # get session key
-        this_session = Session.query(Session.name == request.sessionName).get()
+        this_session = self._getWishlistSession(request)
+        p_key = ndb.Key(Profile, user_id)
+
+        # wishlist key is derived from (userId, session key), so a
+        # duplicate is a single get by key
+        wish = Wishlist(key=self._wishlistKey(user_id, this_session.key),
+            userId=user_id, sessionName=this_session.name,
+            sessionKey=this_session.key, typeOfSession=this_session.typeOfSession)
 
-        # populate dict
-        data = {'userId': user_id, 'sessionName': request.sessionName, 'sessionKey': this_session.key,
-                'typeOfSession': this_session.typeOfSession}
+        # if this session already in user's wishlist, bounce
+        added = self._insertWishlist(p_key, [(wish, schedule.span(this_session))])
+        if wish.key not in added:
+            raise ConflictException('Session added to wishlist already')
+        # the session is added even if it overlaps others; the overlapping
+        # sessions are reported back
+        return mappers.WISHLIST.toForm(wish, conflictingSessionKeys=[
+            s_key.urlsafe() for s_key in added[wish.key]])
 
-        # generate wishlist key from session key
-        p_key = this_session.key
-        c_id = Wishlist.allocate_ids(size=1, parent=p_key)[0]
-        c_key = ndb.Key(Wishlist, c_id, parent=p_key)
-        data['key'] = c_key
 
-        # query wishlist, filter by userId 
-        q = Wishlist.query()
-        q = q.filter(Wishlist.userId == user_id)
+    @staticmethod
+    @ndb.transactional()
+    def _insertWishlist(p_key, entries):
+        """Put the (wish, span) entries whose wish does not exist yet and
+        add their spans to the user's WishlistSchedule, all in the
+        Profile's entity group.
 
-        # if this session already in user's wishlist, bounce
-        for i in q:
-            if i.sessionKey == this_session.key:
-                raise endpoints.UnauthorizedException('Session  added to wishlist already')
+        Return {wish key: keys of the sessions it overlaps} for the wishes
+        put; a wish also overlaps those put before it in the same call.
+        """
+        s_key = schedule.scheduleKey(p_key)
+        found = ndb.get_multi([wish.key for wish, span in entries] + [s_key])
+        # a wishlist that predates schedules gets one here, in the same
+        # transaction as the entries being added
+        wish_schedule = found.pop() or schedule.build(p_key)
+        added = {}
+        for (wish, span), existing in zip(entries, found):
+            if existing or wish.key in added:
+                continue
+            added[wish.key] = []
+            if span:
+                added[wish.key] = schedule.conflicts(wish_schedule, *span)
+                schedule.insert(wish_schedule, wish.sessionKey, *span)
+        if added:
+            ndb.put_multi([wish for wish, span in entries if wish.key in added] +
+                [wish_schedule])
+        return added
 
-        # save to wishlist
-        Wishlist(**data).put()
-        return request
+
+    @staticmethod
+    @ndb.transactional()
+    def _deleteWishlist(p_key, s_key):
+        """Delete the user's Wishlist entry for a session and drop its span
+        from their schedule; return False if there was no entry."""
+        w_key = ConferenceApi._wishlistKey(p_key.id(), s_key)
+        wish, wish_schedule = ndb.get_multi([w_key, schedule.scheduleKey(p_key)])
+        if not wish:
+            return False
+        w_key.delete()
+        # a missing schedule is built from the remaining entries when needed
+        if wish_schedule:
+            schedule.remove(wish_schedule, s_key)
+            wish_schedule.put()
+        return True
 
 
 #--------Sessions to User WishList--------------------------------------
     @endpoints.method(WishlistForm, WishlistForm, path='wishlist',
             http_method='POST', name='addSessionToWishlist')
+    @rpcstats.measured
     def addSessionToWishlist(self, request):
         """dds the session to the user's list of sessions they are interested in attending"""
         return self._createWishlistObject(request)
 
+    @endpoints.method(WishlistForm, BooleanMessage, path='wishlist',
+            http_method='DELETE', name='removeSessionFromWishlist')
+    @rpcstats.measured
+    def removeSessionFromWishlist(self, request):
+        """Remove the session (given by websafeSessionKey) from the user's wishlist."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+        if not request.websafeSessionKey:
+            raise endpoints.BadRequestException('websafeSessionKey required')
+        s_key = ndb.Key(urlsafe=request.websafeSessionKey)
+        return BooleanMessage(data=self._deleteWishlist(ndb.Key(Profile, user_id), s_key))
+
+    @endpoints.method(message_types.VoidMessage, WishlistConflictForms,
+            path='wishlist/conflicts', http_method='GET', name='getWishlistConflicts')
+    @rpcstats.measured
+    def getWishlistConflicts(self, request):
+        """Return the pairs of sessions in the user's wishlist that overlap
+        in time; reads only the user's WishlistSchedule."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        wish_schedule = schedule.ensure(ndb.Key(Profile, getUserId(user)))
+        return WishlistConflictForms(items=[WishlistConflictForm(
+            websafeSessionKeys=[first.urlsafe(), second.urlsafe()],
+            overlapStart=str(schedule.toDatetime(start)),
+            overlapEnd=str(schedule.toDatetime(end)))
+            for first, second, start, end in schedule.overlaps(wish_schedule)])
+
+    @endpoints.method(WishlistBatchForm, WishlistForms, path='wishlist/batch',
+            http_method='POST', name='addSessionsToWishlist')
+    @rpcstats.measured
+    def addSessionsToWishlist(self, request):
+        """Add several sessions to the user's wishlist; return the entries
+        that were added (sessions already in the wishlist are skipped)."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        s_keys = []
+        for wssk in request.websafeSessionKeys:
+            s_key = ndb.Key(urlsafe=wssk)
+            if s_key.kind() != 'Session':
+                raise endpoints.BadRequestException('Not a session key: %s' % wssk)
+            if s_key not in s_keys:
+                s_keys.append(s_key)
+
+        p_key = ndb.Key(Profile, user_id)
+        w_keys = [self._wishlistKey(user_id, s_key) for s_key in s_keys]
+        entities = ndb.get_multi(s_keys + w_keys)
+        sessions, existing = entities[:len(s_keys)], entities[len(s_keys):]
+
+        entries = []
+        for sesh, w_key, wish in zip(sessions, w_keys, existing):
+            if not sesh:
+                raise endpoints.NotFoundException(
+                    'No session found with key: %s' % w_key.id())
+            if not wish:
+                entries.append((Wishlist(key=w_key, userId=user_id,
+                    sessionName=sesh.name, sessionKey=sesh.key,
+                    typeOfSession=sesh.typeOfSession), schedule.span(sesh)))
+        added = self._insertWishlist(p_key, entries) if entries else {}
+
+        wishes = [wish for wish, span in entries if wish.key in added]
+        return WishlistForms(items=mappers.WISHLIST.toForms(wishes,
+            conflictingSessionKeys=[[s_key.urlsafe() for s_key in added[wish.key]]
+                                    for wish in wishes]))
+
     @endpoints.method(message_types.VoidMessage, WishlistForms, path='wishlistQuery',
             http_method='GET', name='getSessionsInWishlist')
+    @rpcstats.measured
     def getSessionsInWishlist(self, request):
         """return a user's wishlist."""
 
@@ -538,15 +1223,46 @@ class ConferenceApi(remote.Service):
             raise endpoints.UnauthorizedException('Authorization required')
         # get userId
         user_id = getUserId(user)
-        # query wishlist, filter by userId
-        q = Wishlist.query().filter(Wishlist.userId == user_id)
+        # wishlist keys for userId, loaded with one get_multi
+        wishes = self._joinWishlist(user_id)
+
+        return WishlistForms(items=mappers.WISHLIST.toForms(wishes))
 
-        return WishlistForms(items=[self._copyWishlistToForm(wish) for wish in q])
+
+    @staticmethod
+    def _keyJoin(keys, other_keys, on=None):
+        """Hash join two keys-only results.
+
+        Return the keys, in order, whose on(key) -- the key itself by
+        default -- appears in other_keys.
+        """
+        other_keys = set(other_keys)
+        if on is None:
+            return [key for key in keys if key in other_keys]
+        return [key for key in keys if on(key) in other_keys]
+
+
+    def _joinWishlist(self, user_id, session_keys=None, where=None):
+        """Return the user's Wishlist entities, optionally restricted to the
+        sessions in session_keys and to the entities satisfying where().
+
+        The user's wishlist is fetched with one keys-only ancestor query and
+        joined against session_keys through a hash set (a Wishlist's ID is
+        its Session's websafe key); only the matching entities are loaded,
+        with one get_multi.
+        """
+        w_keys = Wishlist.query(ancestor=ndb.Key(Profile, user_id)).fetch(keys_only=True)
+        if session_keys is not None:
+            w_keys = self._keyJoin(w_keys, session_keys,
+                on=lambda key: ndb.Key(urlsafe=key.id()))
+        wishes = ndb.get_multi(w_keys)
+        return [wish for wish in wishes if wish and (where is None or where(wish))]
 
 
 #-----Two Additional Queries------------------------------------
     @endpoints.method(WishlistTypeQuery, WishlistForms, path='wishlistTypeQuery',
             http_method='GET', name='returnWishlistType')
+    @rpcstats.measured
     def returnWishlistType(self, request):
         """Return whislist by type."""
 
@@ -558,15 +1274,15 @@ class ConferenceApi(remote.Service):
         # acquire userId
         user_id = getUserId(user)
 
-        # query wishlist, filter by userId and typeOfSession
-        q = Wishlist.query()
-        q = q.filter(Wishlist.userId == user_id)
-        q = q.filter(Wishlist.typeOfSession == request.typeOfSession)
+        # user's wishlist, filtered by typeOfSession
+        wishes = self._joinWishlist(user_id,
+            where=lambda wish: request.typeOfSession in wish.typeOfSession)
 
-        return WishlistForms(items=[self._copyWishlistToForm(wish) for wish in q])
+        return WishlistForms(items=mappers.WISHLIST.toForms(wishes))
 
     @endpoints.method(WishlistSpeakerQuery, WishlistForms, path='wishlistSpeakerQuery',
             http_method='GET', name='returnWishlistSpeaker')
+    @rpcstats.measured
     def returnWishlistSpeaker(self, request):
         """Given a speaker, return the wishlist by the speaker."""
 
@@ -578,60 +1294,52 @@ class ConferenceApi(remote.Service):
         # obtain userId
         user_id = getUserId(user)
 
-        # query session, filter by speaker
-        q = Session.query().filter(Session.speaker == request.speaker)
+        # session keys for speaker, joined with the user's wishlist keys
+        s_keys = Session.query(Session.speaker == request.speaker).fetch(keys_only=True)
+        wishes = self._joinWishlist(user_id, session_keys=s_keys)
 
-        # query wishlist, filter by userId
-        p = Wishlist.query().filter(Wishlist.userId == user_id)
-
-        a = []
-        for s in q:
-            for w in p:
-                if s.key == w.sessionKey:
-                    a.append(w)
-
-        return WishlistForms(items=[self._copyWishlistToForm(wish) for wish in a])
+        return WishlistForms(items=mappers.WISHLIST.toForms(wishes))
 
 
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
     def _copyProfileToForm(self, prof):
         """Copy relevant fields from Profile to ProfileForm."""
-        # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
-        return pf
+        return mappers.PROFILE.toForm(prof)
 
 
     def _getProfileFromUser(self):
         """Return user Profile from datastore, creating new one if non-existent."""
+        return self._getProfileFromUserAsync().get_result()
+
+
+    def _getProfileKey(self):
+        """Return the key of the current user's Profile."""
         # make sure user is authed
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
+        return ndb.Key(Profile, getUserId(user))
+
 
+    @ndb.tasklet
+    def _getProfileFromUserAsync(self):
+        """Return a future for the user Profile, creating it if non-existent."""
         # get Profile from datastore
-        user_id = getUserId(user)
-        p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
+        p_key = self._getProfileKey()
+        profile = yield p_key.get_async()
         # create new Profile if not there
         if not profile:
+            user = endpoints.get_current_user()
             profile = Profile(
                 key = p_key,
                 displayName = user.nickname(),
                 mainEmail= user.email(),
                 teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
             )
-            profile.put()
+            yield profile.put_async()
 
-        return profile      # return Profile
+        raise ndb.Return(profile)      # return Profile
 
 
     def _doProfile(self, save_request=None):
@@ -641,6 +1349,7 @@ class ConferenceApi(remote.Service):
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
+            displayName = prof.displayName
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
@@ -650,21 +1359,72 @@ class ConferenceApi(remote.Service):
                         #    setattr(prof, field, str(val).upper())
                         #else:
                         #    setattr(prof, field, val)
-            prof.put()
+            # the user's conferences carry the organizer's display name;
+            # rewrite them off the request path, with a task added in the
+            # same transaction as the profile so a new name is never left
+            # uncopied
+            def save():
+                prof.put()
+                if prof.displayName != displayName:
+                    taskqueue.add(params={'userId': prof.key.id()},
+                        url='/tasks/update_organizer_name', transactional=True
+                    )
+            ndb.transaction(save)
 
         # return ProfileForm
-        return self._copyProfileToForm(prof)
+        form = self._copyProfileToForm(prof)
+        form.etag = self._etag('profile', prof.key.id(), prof.modified)
+        return form
+
+
+    @staticmethod
+    def _updateOrganizerName(user_id, cursor=None):
+        """Copy a user's current displayName onto one batch of the
+        conferences they organize; return the cursor of the next batch or
+        None.  Used by the update_organizer_name task.
+        """
+        p_key = ndb.Key(Profile, user_id)
+
+        def update(c_keys):
+            ConferenceApi._setOrganizerName(p_key, c_keys)
+            ConferenceApi._bumpConferenceVersions(c_keys)
+            querycache.bumpGeneration()
+        return mapPage(Conference.query(ancestor=p_key), update, cursor,
+            FANOUT_BATCH_SIZE, keys_only=True)
 
 
-    @endpoints.method(message_types.VoidMessage, ProfileForm,
+    @staticmethod
+    @ndb.transactional()
+    def _setOrganizerName(p_key, c_keys):
+        """Set organizerDisplayName on conferences from the Profile; they
+        share the Profile's entity group, so this is one transaction."""
+        entities = ndb.get_multi([p_key] + c_keys)
+        prof, confs = entities[0], entities[1:]
+        changed = [conf for conf in confs
+            if conf and conf.organizerDisplayName != prof.displayName]
+        for conf in changed:
+            conf.organizerDisplayName = prof.displayName
+        ndb.put_multi(changed)
+
+
+    @endpoints.method(ConditionalRequest, ProfileForm,
             path='profile', http_method='GET', name='getProfile')
+    @rpcstats.measured
     def getProfile(self, request):
-        """Return user profile."""
-        return self._doProfile()
+        """Return user profile, or only notModified if the client's ETag
+        matches the Profile's modified stamp."""
+        prof = self._getProfileFromUser()
+        etag = self._etag('profile', prof.key.id(), prof.modified)
+        if request.etag == etag:
+            return ProfileForm(etag=etag, notModified=True)
+        form = self._copyProfileToForm(prof)
+        form.etag = etag
+        return form
 
 
     @endpoints.method(ProfileMiniForm, ProfileForm,
             path='profile', http_method='POST', name='saveProfile')
+    @rpcstats.measured
     def saveProfile(self, request):
         """Update & return user profile."""
         return self._doProfile(request)
@@ -672,119 +1432,351 @@ class ConferenceApi(remote.Service):
 # - - - Memecache Announcements - - - - - - - - - - - - - - - - - - - -
 
     @staticmethod
-    def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
+    def _announcementText(state):
+        """Return the announcement for an AnnouncementState (or None)."""
+        if not state or not state.conferenceNames:
+            return ""
+        return ANNOUNCEMENT_TPL % ', '.join(state.conferenceNames)
+
+
+    @staticmethod
+    def _noteSeats(conferences):
+        """Add conferences to, or drop them from, the announcement as their
+        open seats cross ANNOUNCEMENT_SEATS; called after seats change."""
+        open_seats, state = rpcstats.gather(
+            lambda: seats.getSeatsAvailableMultiAsync(conferences),
+            lambda: AnnouncementState.get_by_id_async(ANNOUNCEMENT_STATE_ID)).get_result()
+        ConferenceApi._updateAnnouncement(dict(
+            (conf.key, conf.name if 0 < open_seats[conf.key] <= ANNOUNCEMENT_SEATS else None)
+            for conf in conferences), state)
+
+
+    @staticmethod
+    def _updateAnnouncement(members, state=None):
+        """Apply {conference key: name, or None if not nearly sold out} to
+        the AnnouncementState and the cached announcement.
+
+        `state` is a copy read outside a transaction; when it already
+        agrees, nothing is written, so only threshold crossings touch the
+        singleton.
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+        if state is None:
+            state = AnnouncementState.get_by_id(ANNOUNCEMENT_STATE_ID)
+        current = dict(zip(state.conferenceKeys, state.conferenceNames)) if state else {}
+        if all(current.get(key) == name for key, name in members.items()):
+            return
+        ConferenceApi._applyAnnouncement(members)
 
-        return announcement
 
+    @staticmethod
+    @ndb.transactional()
+    def _applyAnnouncement(members):
+        state = (AnnouncementState.get_by_id(ANNOUNCEMENT_STATE_ID) or
+                 AnnouncementState(id=ANNOUNCEMENT_STATE_ID))
+        current = collections.OrderedDict(zip(state.conferenceKeys, state.conferenceNames))
+        for key, name in members.items():
+            if name is None:
+                current.pop(key, None)
+            else:
+                current[key] = name
+        state.conferenceKeys = current.keys()
+        state.conferenceNames = current.values()
+        state.put()
+        # cached with the state's modified stamp, for the ETag
+        announcement = (state.modified, ConferenceApi._announcementText(state))
+        ndb.get_context().call_on_commit(
+            lambda: memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement))
 
-    @endpoints.method(message_types.VoidMessage, StringMessage,
+
+    @staticmethod
+    def _reconcileAnnouncement(cursor=None):
+        """Recheck one batch of conferences against the seat counter, for
+        registrations whose announcement update was lost: sync their
+        Conference.seatsAvailable copies and fix their place in the
+        announcement.  Return the cursor of the next batch or None.
+        """
+        def reconcile(confs):
+            open_seats = seats.getSeatsAvailableMulti(confs)
+            for conf in confs:
+                if conf.seatShards and conf.seatsAvailable != open_seats[conf.key]:
+                    ConferenceApi._syncSeatsAvailable(conf.key, open_seats[conf.key])
+            ConferenceApi._updateAnnouncement(dict(
+                (conf.key, conf.name if 0 < open_seats[conf.key] <= ANNOUNCEMENT_SEATS else None)
+                for conf in confs))
+        return mapPage(Conference.query(), reconcile, cursor, MIGRATION_BATCH_SIZE)
+
+
+    @staticmethod
+    @ndb.transactional()
+    def _syncSeatsAvailable(conf_key, count):
+        """Store the seat counter's value on the Conference entity."""
+        conf = conf_key.get()
+        conf.seatsAvailable = count
+        conf.put()
+
+
+    @endpoints.method(ConditionalRequest, StringMessage,
             path='conference/announcement/get',
             http_method='GET', name='getAnnouncement')
+    @rpcstats.measured
     def getAnnouncement(self, request):
-        """Return Announcement from memcache."""
-        announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
-        if not announcement:
-            announcement = ANNOUNCEMENT_TPL+str(time.ctime())
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        """Return Announcement from memcache, falling back to the
+        AnnouncementState that registrations keep up to date; empty with
+        notModified if the client's ETag matches the state's stamp."""
+        cached = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+        if cached is None:
+            state = AnnouncementState.get_by_id(ANNOUNCEMENT_STATE_ID)
+            cached = (state.modified if state else None, self._announcementText(state))
+            memcache.add(MEMCACHE_ANNOUNCEMENTS_KEY, cached)
+        modified, announcement = cached
+        etag = self._etag('announcement', modified)
+        if request.etag == etag:
+            return StringMessage(data='', etag=etag, notModified=True)
+        return StringMessage(data=announcement, etag=etag)
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
-    @ndb.transactional(xg=True)
+    @staticmethod
+    def _registrationKey(p_key, conf_key):
+        """Return the key of the Registration of a user for a conference."""
+        return ndb.Key(Registration, conf_key.urlsafe(), parent=p_key)
+
+
     def _conferenceRegistration(self, request, reg=True):
-        """Register or unregister user for selected conference."""
-        retval = None
-        prof = self._getProfileFromUser() # get user Profile
+        """Register or unregister user for selected conference.
 
-        # check if conf exists given websafeConfKey
-        # get conference; check that it exists
+        Seats are taken from one shard of the conference's seat counter and
+        the registration is a Registration child of the user's Profile, so
+        the transaction never rewrites the Conference or the Profile.
+        """
+        # get user Profile, conference and any existing registration at once
         wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
+        p_key = self._getProfileKey()
+        c_key = ndb.Key(urlsafe=wsck)
+        prof, conf, registration = rpcstats.gather(
+            lambda: self._getProfileFromUserAsync(),
+            lambda: c_key.get_async(),
+            lambda: self._registrationKey(p_key, c_key).get_async()).get_result()
+
+        # check that conference exists
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
+        if seats.ensureSeats(conf):
+            # cached query pages take the seats of unsharded conferences
+            # from the entity
+            querycache.bumpGeneration()
+
+        # unregister
+        if not reg:
+            retval = self._unregister(prof.key, conf)
+            if retval:
+                self._bumpConferenceVersions([conf.key])
+                self._noteSeats([conf])
+            return BooleanMessage(data=retval)
 
         # register
-        if reg:
-            # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
-                raise ConflictException(
-                    "You have already registered for this conference")
-
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
-                raise ConflictException(
-                    "There are no seats available.")
-
-            # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable -= 1
-            retval = True
+        # check if user already registered otherwise add
+        if registration or wsck in prof.conferenceKeysToAttend:
+            raise ConflictException(
+                "You have already registered for this conference")
 
-        # unregister
+        self._takeSeat(prof.key, conf)
+        self._bumpConferenceVersions([conf.key])
+        self._noteSeats([conf])
+        return BooleanMessage(data=True)
+
+
+    def _takeSeat(self, p_key, conf):
+        """Register a user for a conference, taking a seat from a shard.
+
+        A shard that empties, or is too contended to commit, before the
+        registration does is swapped for another, up to
+        REGISTRATION_RETRIES times; raise ConflictException if no seat
+        could be taken.
+        """
+        contended = False
+        for attempt in range(REGISTRATION_RETRIES):
+            try:
+                shard_key = seats.pickShard(conf)
+            except seats.NoSeatsAvailable:
+                contended = False
+                break
+            try:
+                if self._register(p_key, conf, shard_key):
+                    return
+                contended = False
+            except datastore_errors.TransactionFailedError:
+                contended = True
+        if contended:
+            raise ConflictException(
+                "Too many registrations at once; please try again.")
+        raise ConflictException(
+            "There are no seats available.")
+
+
+    @ndb.transactional(xg=True)
+    def _register(self, p_key, conf, shard_key):
+        """Take a seat from shard_key and store the user's Registration.
+
+        Return False if the shard ran out of seats.
+        """
+        r_key = self._registrationKey(p_key, conf.key)
+        prof, registration = ndb.get_multi([p_key, r_key])
+        if registration or conf.key.urlsafe() in prof.conferenceKeysToAttend:
+            raise ConflictException(
+                "You have already registered for this conference")
+        if not seats.takeSeat(conf, shard_key):
+            return False
+        Registration(key=r_key, conferenceKey=conf.key).put()
+        return True
+
+
+    @ndb.transactional(xg=True)
+    def _unregister(self, p_key, conf):
+        """Give the user's seat back to the pool; False if not registered."""
+        r_key = self._registrationKey(p_key, conf.key)
+        prof, registration = ndb.get_multi([p_key, r_key])
+        wsck = conf.key.urlsafe()
+        if registration:
+            r_key.delete()
+        elif wsck in prof.conferenceKeysToAttend:
+            # registered before Registration entities were introduced
+            prof.conferenceKeysToAttend.remove(wsck)
+            prof.put()
         else:
-            # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            return False
+        seats.releaseSeat(conf)
+        return True
+
+
+    @staticmethod
+    def _attendingConferenceKeys(prof, r_keys):
+        """Return the keys of the conferences the user registered for,
+        given the user's Profile and Registration keys."""
+        conf_keys = [ndb.Key(urlsafe=r_key.id()) for r_key in r_keys]
+        # profiles not yet migrated still carry their registrations inline
+        for wsck in prof.conferenceKeysToAttend:
+            conf_key = ndb.Key(urlsafe=wsck)
+            if conf_key not in conf_keys:
+                conf_keys.append(conf_key)
+        return conf_keys
 
-                # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
-                retval = True
-            else:
-                retval = False
 
-        # write things back to the datastore & return
+    @staticmethod
+    def _attendeeProfileKeys(conf_key):
+        """Return the Profile keys of the users registered for a conference."""
+        return [r_key.parent() for r_key in Registration.query(
+            Registration.conferenceKey == conf_key).fetch(keys_only=True)]
+
+
+    @staticmethod
+    def _migrateRegistrations(cursor=None):
+        """Move one batch of Profile.conferenceKeysToAttend lists into
+        Registration entities; return the cursor of the next batch or None.
+        """
+        def migrate(p_keys):
+            for p_key in p_keys:
+                ConferenceApi._migrateProfileRegistrations(p_key)
+        return mapPage(Profile.query(), migrate, cursor, MIGRATION_BATCH_SIZE,
+            keys_only=True)
+
+
+    @staticmethod
+    @ndb.transactional()
+    def _migrateProfileRegistrations(p_key):
+        """Replace one Profile's conferenceKeysToAttend list with
+        Registration children, in the Profile's entity group.
+        """
+        prof = p_key.get()
+        if not prof or not prof.conferenceKeysToAttend:
+            return
+        ndb.put_multi([Registration(
+            key=ConferenceApi._registrationKey(p_key, ndb.Key(urlsafe=wsck)),
+            conferenceKey=ndb.Key(urlsafe=wsck))
+            for wsck in prof.conferenceKeysToAttend])
+        prof.conferenceKeysToAttend = []
         prof.put()
-        conf.put()
-        return BooleanMessage(data=retval)
 
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @staticmethod
+    def _migrateWishlists(cursor=None):
+        """Move one batch of Wishlist entities parented under their Session
+        to the user's Profile; return the cursor of the next batch or None.
+        """
+        def migrate(wishes):
+            legacy = [wish for wish in wishes if wish.key.parent().kind() == 'Session']
+            # the new keys are deterministic, so a retried batch rewrites
+            # the same entities
+            ndb.put_multi([Wishlist(
+                key=ConferenceApi._wishlistKey(wish.userId, wish.sessionKey),
+                userId=wish.userId, sessionName=wish.sessionName,
+                sessionKey=wish.sessionKey, typeOfSession=wish.typeOfSession)
+                for wish in legacy])
+            ndb.delete_multi([wish.key for wish in legacy])
+        return mapPage(Wishlist.query(), migrate, cursor, MIGRATION_BATCH_SIZE)
+
+
+    @endpoints.method(CONF_LIST_REQUEST, ConferenceForms,
             path='conferences/attending',
             http_method='GET', name='getConferencesToAttend')
+    @rpcstats.measured
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
-        prof = self._getProfileFromUser() # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
-
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        return self._getConferencesToAttendAsync(request.view, request.etag).get_result()
+
+
+    @ndb.tasklet
+    def _getConferencesToAttendAsync(self, view=None, etag=None):
+        # user Profile and Registration keys are read in parallel
+        p_key = self._getProfileKey()
+        prof, r_keys = yield rpcstats.gather(
+            lambda: self._getProfileFromUserAsync(),
+            lambda: Registration.query(ancestor=p_key).fetch_async(keys_only=True))
+        conf_keys = self._attendingConferenceKeys(prof, r_keys)
+
+        # the ETag covers which conferences are listed and their version
+        # stamps, which registrations bump as seats change
+        versions = yield self._conferenceVersionsAsync(conf_keys)
+        tag = None
+        if None not in versions.values():
+            tag = self._etag('attending', str(view),
+                [(key.urlsafe(), versions[key]) for key in conf_keys])
+            if etag == tag:
+                raise ndb.Return(ConferenceForms(etag=tag, notModified=True))
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])\
-         for conf in conferences]
-        )
+        forms = yield self._listConferencesAsync(view, conf_keys=conf_keys)
+        forms.etag = tag
+        raise ndb.Return(forms)
+
+
+    @endpoints.method(CONF_GET_REQUEST, ProfileForms,
+            path='conference/{websafeConferenceKey}/attendees',
+            http_method='GET', name='getConferenceAttendees')
+    @rpcstats.measured
+    def getConferenceAttendees(self, request):
+        """Return the profiles of users registered for a conference;
+        open only to the organizer of the conference."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        if getUserId(user) != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can list the attendees.')
+        profiles = ndb.get_multi(self._attendeeProfileKeys(conf.key))
+        return ProfileForms(
+            items=mappers.PROFILE.toForms([prof for prof in profiles if prof]))
 
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='POST', name='registerForConference')
+    @rpcstats.measured
     def registerForConference(self, request):
         """Register user for selected conference."""
         return self._conferenceRegistration(request)
@@ -793,6 +1785,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='DELETE', name='unregisterFromConference')
+    @rpcstats.measured
     def unregisterFromConference(self, request):
         """Unregister user for selected conference."""
         return self._conferenceRegistration(request, reg=False)
@@ -802,63 +1795,85 @@ class ConferenceApi(remote.Service):
 #----------QueryProblem---------------------------
     @endpoints.method(SessionQuery, SessionForms, path='sessionProblemQuery',
             http_method='GET', name='problematicQuery')
+    @rpcstats.measured
     def problematicQuery(self, request):
         """Handle query for all non-workshop sessions before 7 pm."""
 
         if not request.websafeConferenceKey:
             raise endpoints.ForbiddenException('Requires websafeConferenceKey.')
 
-        #24hr format
-        time_is_now = datetime.strptime('19:00:00', "%H:%M:%S").time()
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        # the datastore allows only one inequality filter per query, so
+        # the timetable is searched by start time (24hr format) and
+        # workshops are dropped in memory
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        table = self._getTimetable(c_key)
+        list_loader = timetable.startingBy(table, '19:00:00', exclude_type="Workshop")
 
-        query_sesh = Session.query(ancestor=conf.key).\
-            filter(Session.startTime <= time_is_now)
-
-        list_loader = []
-        for stuff in query_sesh:
-            if "Workshop" not in stuff.typeOfSession:
-                list_loader.append(stuff)
-
-        return SessionForms(items=[self._transferSessionToForm(sesh) for sesh in list_loader])
+        return SessionForms(items=timetable.toForms(c_key, list_loader))
 
 
 #-------featuredSpeaker-------------------------------
 
     @staticmethod
-    def _cacheFeaturedSpeaker(websafeConferenceKey, sessionId):
-        """Search for featured speaker.
+    def _cacheFeaturedSpeaker(websafeSessionKeys):
+        """Count new sessions in their speakers' SpeakerStats and make the
+        speaker with the most sessions at a conference (more than one) the
+        featured speaker in memcache; used by the set_featured_speaker task
+        queued on session creation.
         """
-        #  obtainthe conference
-        c= ndb.Key(urlsafe=websafeConferenceKey)
-        if c.kind() != 'Conference':
-            # raising an exception 
-            logging.error("invalid key here %s"  %websafeConferenceKey)
-            return
-        # verify existence of created session
-        session = Session.get_by_id(int(sessionId), parent=conf)
-        if not session:
-            logging.error("session id not found")
-            return
-        # check the speakers in the session
-        for speaker in session.speaker:
-            logging.info(speaker.urlsafe())
-            sessions = Session.query(Session.speaker == speaker).fetch(projection=[Session.name])
-            logging.info(len(sessions))
-            if len(sessions) > 1:
-                speaker = speaker.get()
-                feature =(speaker.name, ', '.join(sess.name for sess in sessions))
+        s_keys = []
+        for websafeSessionKey in websafeSessionKeys:
+            s_key = ndb.Key(urlsafe=websafeSessionKey)
+            if s_key.kind() != 'Session':
+                logging.error("invalid key here %s" % websafeSessionKey)
+                continue
+            s_keys.append(s_key)
+
+        # verify existence of created sessions, grouped by speaker
+        by_speaker = {}
+        for s_key, session in zip(s_keys, ndb.get_multi(s_keys)):
+            if not session:
+                logging.error("session not found: %s" % s_key.urlsafe())
+                continue
+            by_speaker.setdefault((s_key.parent(), session.speaker), []).append(session)
+
+        featured = None
+        for (c_key, speaker), sessions in by_speaker.items():
+            stats = ConferenceApi._countSpeakerSessions(c_key, speaker, sessions)
+            if stats.sessionCount > 1 and (
+                    not featured or stats.sessionCount > featured[1].sessionCount):
+                featured = (speaker, stats)
+        if featured:
+            speaker, stats = featured
+            featured = FEATURED_SPEAKER_TPL % (speaker, ', '.join(stats.sessionNames))
+            memcache.set(MEMCACHE_SPEAKER_KEY, featured)
+            return featured
 
-                # memcaching
-                memcache.set(MEMCACHE_FEATUREDSPEAKER_KEY, feature)
-                return feature
+
+    @staticmethod
+    @ndb.transactional()
+    def _countSpeakerSessions(c_key, speaker, sessions):
+        """Add a speaker's sessions to their SpeakerStats, skipping those
+        counted already (tasks may run more than once); return the stats.
+        """
+        st_key = ndb.Key(SpeakerStats, speaker, parent=c_key)
+        stats = st_key.get() or SpeakerStats(key=st_key)
+        new = [session for session in sessions if session.key not in stats.sessionKeys]
+        if new:
+            stats.sessionKeys.extend(session.key for session in new)
+            stats.sessionNames.extend(session.name for session in new)
+            stats.sessionCount += len(new)
+            stats.put()
+        return stats
 
 
     @endpoints.method(message_types.VoidMessage, StringMessage,
             path='sessions/featured/get',
             http_method='GET', name='getFeaturedSpeaker')
+    @rpcstats.measured
     def getFeaturedSpeaker(self, request):
-        """get Featured Speaker."""
+        """get Featured Speaker; a memcache read only, kept fresh by the
+        set_featured_speaker task."""
         return StringMessage(data=memcache.get(MEMCACHE_SPEAKER_KEY) or "")
 
 
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+"""facets.py -- sharded facet counters for conference listings
+
+The number of conferences per city, topic, start month and maxAttendees
+bucket is kept in NUM_SHARDS root FacetShard entities, each holding part
+of every count as {field: {value: count}}.  A conference write adds its
+changes to one random shard, in the same transaction as the write, so it
+costs one more entity group however many facets change, and concurrent
+writes spread over the shards.  Reading the facets sums the shards with
+one get_multi; the result is cached in memcache and dropped whenever a
+count changes.
+
+"""
+
+import collections
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import FacetShard
+from utils import mapPage
+
+NUM_SHARDS = 20
+REBUILD_ID = 'rebuild'
+REBUILD_BATCH_SIZE = 200
+MEMCACHE_FACETS_KEY = "CONFERENCE_FACETS"
+FACETS_CACHE_TTL = 60
+
+FIELDS = ('city', 'topics', 'month', 'maxAttendees')
+# upper bounds of the maxAttendees buckets; larger values go in a last,
+# open bucket
+MAX_ATTENDEES_BUCKETS = (0, 10, 50, 100, 500)
+
+
+def _shardKey(index):
+    return ndb.Key(FacetShard, 'shard:%d' % index)
+
+
+def _shardKeys():
+    return [_shardKey(i) for i in range(NUM_SHARDS)]
+
+
+def _bucket(max_attendees):
+    """Return the label of the maxAttendees bucket holding a value."""
+    low = 0
+    for high in MAX_ATTENDEES_BUCKETS:
+        if max_attendees <= high:
+            return str(high) if low >= high else '%d-%d' % (low, high)
+        low = high + 1
+    return '>%d' % MAX_ATTENDEES_BUCKETS[-1]
+
+
+def facetValues(conferences):
+    """Return the (field, value) pairs the conferences are counted under,
+    one per conference per value."""
+    values = []
+    for conf in conferences:
+        if conf.city:
+            values.append(('city', conf.city))
+        values.extend(('topics', topic) for topic in set(conf.topics))
+        if conf.month:
+            values.append(('month', str(conf.month)))
+        values.append(('maxAttendees', _bucket(conf.maxAttendees or 0)))
+    return values
+
+
+def changes(before=(), after=()):
+    """Return {(field, value): change in count} for conferences going from
+    the facet values `before` to `after`, leaving out unchanged counts."""
+    counts = collections.Counter(after)
+    counts.subtract(before)
+    return dict((value, n) for value, n in counts.items() if n)
+
+
+def _addCounts(counts, changed):
+    """Add {(field, value): change} to {field: {value: count}} in place,
+    dropping counts that reach zero."""
+    for (field, value), n in changed.items():
+        values = counts.setdefault(field, {})
+        values[value] = values.get(value, 0) + n
+        if not values[value]:
+            del values[value]
+
+
+@ndb.tasklet
+def adjustAsync(changed):
+    """Add the changes to one random shard; must run inside a transaction
+    that may span another entity group."""
+    if not changed:
+        return
+    key = _shardKey(random.randrange(NUM_SHARDS))
+    shard = yield key.get_async()
+    shard = shard or FacetShard(key=key, counts={})
+    _addCounts(shard.counts, changed)
+    yield shard.put_async()
+    ndb.get_context().call_on_commit(lambda: memcache.delete(MEMCACHE_FACETS_KEY))
+
+
+def adjust(changed):
+    """Add the changes to one random shard; see adjustAsync()."""
+    adjustAsync(changed).get_result()
+
+
+def getFacets():
+    """Return {field: {value: count}} over all conferences.
+
+    Served from memcache; a miss sums the shards.  A count read while a
+    write commits may be cached for up to FACETS_CACHE_TTL seconds.
+    """
+    counts = memcache.get(MEMCACHE_FACETS_KEY)
+    if counts is not None:
+        return counts
+    counts = dict((field, {}) for field in FIELDS)
+    for shard in ndb.get_multi(_shardKeys()):
+        if shard:
+            for field, values in shard.counts.items():
+                totals = counts.setdefault(field, {})
+                for value, n in values.items():
+                    totals[value] = totals.get(value, 0) + n
+    memcache.add(MEMCACHE_FACETS_KEY, counts, time=FACETS_CACHE_TTL)
+    return counts
+
+
+def rebuild(cursor=None):
+    """Recount one batch of conferences; after the last batch replace the
+    shards with the new counts.  Return the cursor of the next batch or
+    None.
+
+    The counts so far are kept in a FacetShard outside the shard set,
+    together with the cursor they reach, so a batch run again by a retried
+    task is not counted twice.  Starting without a cursor starts over.
+    Conferences written while a rebuild runs may be miscounted, so run it
+    again if the counts still drift.
+    """
+    rebuild_key = ndb.Key(FacetShard, REBUILD_ID)
+    if not cursor:
+        FacetShard(key=rebuild_key, counts={}, cursor='').put()
+    batch = {}
+    next_cursor = mapPage(Conference.query(),
+        lambda confs: batch.update(changes(after=facetValues(confs))),
+        cursor, REBUILD_BATCH_SIZE)
+    return _applyBatch(cursor or '', next_cursor, batch)
+
+
+@ndb.transactional(xg=True)
+def _applyBatch(start, next_cursor, changed):
+    """Add the counts of the batch at `start` to the partial counts unless
+    they are there already; after the last batch put all the counts in
+    the first shard and empty the others.  Return the cursor to continue
+    from."""
+    rebuild_key = ndb.Key(FacetShard, REBUILD_ID)
+    partial = rebuild_key.get()
+    if not partial:
+        # an earlier run of the last batch finished the rebuild
+        return None
+    if partial.cursor != start:
+        return partial.cursor
+    _addCounts(partial.counts, changed)
+    if next_cursor:
+        partial.cursor = next_cursor
+        partial.put()
+        return next_cursor
+    ndb.put_multi([FacetShard(key=key, counts=partial.counts if i == 0 else {})
+                   for i, key in enumerate(_shardKeys())])
+    rebuild_key.delete()
+    ndb.get_context().call_on_commit(lambda: memcache.delete(MEMCACHE_FACETS_KEY))
+    return None
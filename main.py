@@ -1,14 +1,31 @@
 #!/usr/bin/env python
+import cgi
+import json
+
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+from google.appengine.ext.webapp import blobstore_handlers
 from conference import ConferenceApi
 
+import bulk
+import facets
+import planner
+import querycache
+import rpcstats
+import textindex
+
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
-        """Set Announcement in Memcache."""
-        # use _cacheAnnouncement() to set announcement in Memcache
-        ConferenceApi._cacheAnnouncement()
+        """Reconcile the announcement with the seat counters.
+
+        Registrations keep the announcement current; this only repairs
+        missed updates, in a chain of /tasks/reconcile_announcement tasks.
+        """
+        taskqueue.add(url=ReconcileAnnouncementHandler.url)
         
 
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
@@ -27,13 +44,211 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
 class SetFeaturedSpeakerHandler(webapp2.RequestHandler):
     def post(self):
         """Set Featured Speaker in Memcache."""
-        speaker = self.request.get('speaker')
-        ConferenceApi._cacheFeaturedSpeaker(speaker)
+        ConferenceApi._cacheFeaturedSpeaker(
+            self.request.get_all('websafeSessionKey'))
+        self.response.set_status(204)
+
+class UpdateOrganizerNameHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy an organizer's new name onto a batch of their conferences
+        and chain the next batch."""
+        user_id = self.request.get('userId')
+        cursor = ConferenceApi._updateOrganizerName(user_id, self.request.get('cursor'))
+        if cursor:
+            taskqueue.add(params={'userId': user_id, 'cursor': cursor},
+                url='/tasks/update_organizer_name')
+        self.response.set_status(204)
+
+
+class IndexConferencesHandler(webapp2.RequestHandler):
+    def post(self):
+        """Bring the search index up to date with written conferences."""
+        textindex.indexKeys([ndb.Key(urlsafe=wsck)
+            for wsck in self.request.get_all('websafeConferenceKey')])
+        self.response.set_status(204)
+
+class RecordQueryStatsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Fold a sample of a query's filter pass rates into the planner's
+        statistics."""
+        planner.updateStats(self.request.get('kind'),
+            json.loads(self.request.get('observations')))
         self.response.set_status(204)
 
 
+class MigrationHandler(webapp2.RequestHandler):
+    """Runs a data migration as a chain of cursor-driven tasks.
+
+    Subclasses set `migrate`, a function that migrates the batch at a
+    cursor and returns the cursor of the next batch or None, and `url`,
+    where they are routed.
+    """
+    url = None
+    migrate = None
+
+    def get(self):
+        """Start the migration."""
+        taskqueue.add(url=self.url)
+
+    def post(self):
+        """Migrate one batch and chain the next batch."""
+        cursor = self.migrate(self.request.get('cursor'))
+        if cursor:
+            taskqueue.add(params={'cursor': cursor}, url=self.url)
+        self.response.set_status(204)
+
+
+class MigrateRegistrationsHandler(MigrationHandler):
+    """Move Profile registration lists into Registration entities."""
+    url = '/tasks/migrate_registrations'
+    migrate = staticmethod(ConferenceApi._migrateRegistrations)
+
+
+class MigrateWishlistsHandler(MigrationHandler):
+    """Move Wishlist entities under the user's Profile."""
+    url = '/tasks/migrate_wishlists'
+    migrate = staticmethod(ConferenceApi._migrateWishlists)
+
+class ReconcileAnnouncementHandler(MigrationHandler):
+    """Recheck conferences' seats against the announcement."""
+    url = '/tasks/reconcile_announcement'
+    migrate = staticmethod(ConferenceApi._reconcileAnnouncement)
+
+class ReindexConferencesHandler(MigrationHandler):
+    """Add conferences to the search index."""
+    url = '/tasks/reindex_conferences'
+    migrate = staticmethod(textindex.reindex)
+
+class RebuildFacetsHandler(MigrationHandler):
+    """Recount the conference facet counters from the conferences."""
+    url = '/tasks/rebuild_facets'
+    migrate = staticmethod(facets.rebuild)
+
+class ExportHandler(webapp2.RequestHandler):
+    def get(self):
+        """Export one segment of conferences or sessions as JSONL or CSV.
+
+        The X-Next-Cursor response header carries the cursor of the next
+        segment; it is absent once the export is complete.
+        """
+        fmt = self.request.get('format', 'jsonl')
+        self.response.content_type = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+        try:
+            cursor = bulk.exportRows(self.request.get('kind'), fmt,
+                self.response.out, self.request.get('cursor'))
+        except bulk.BulkError as e:
+            self.abort(400, str(e))
+        if cursor:
+            self.response.headers['X-Next-Cursor'] = cursor
+
+
+class ImportFormHandler(webapp2.RequestHandler):
+    def get(self):
+        """Show the form for uploading a file to import."""
+        self.response.write(
+            '<form action="%s" method="POST" enctype="multipart/form-data">'
+            '<select name="kind"><option>conference</option><option>session</option></select>'
+            '<select name="format"><option>jsonl</option><option>csv</option></select>'
+            '<input type="file" name="file"><input type="submit" value="Import">'
+            '</form>' % blobstore.create_upload_url('/admin/import/upload'))
+
+
+class ImportUploadHandler(blobstore_handlers.BlobstoreUploadHandler):
+    def post(self):
+        """Start importing an uploaded file."""
+        uploads = self.get_uploads('file')
+        if not uploads:
+            self.abort(400, 'No file uploaded.')
+        try:
+            job = bulk.startImport(uploads[0].key(), self.request.get('kind'),
+                self.request.get('format'))
+        except bulk.BulkError as e:
+            self.abort(400, str(e))
+        self.response.write('Import job %d started.' % job.key.id())
+
+
+class ImportResumeHandler(webapp2.RequestHandler):
+    def post(self):
+        """Resume a failed import job from its last committed offset."""
+        job = bulk.resumeImport(int(self.request.get('job')))
+        if not job:
+            self.abort(404, 'No such import job.')
+        self.response.write('Import job %d resumed at offset %d.' % (
+            job.key.id(), job.offset))
+
+
+class ImportChunkHandler(webapp2.RequestHandler):
+    def post(self):
+        """Import one chunk of an import job."""
+        bulk.importChunk(int(self.request.get('job')))
+        self.response.set_status(204)
+
+
+class StatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Show the sampled per-method latency histograms and RPC counts
+        and the queryConferences cache counts, as HTML or, with
+        format=json, as JSON."""
+        stats = rpcstats.getStats()
+        cache_stats = querycache.getStats()
+        if self.request.get('format') == 'json':
+            self.response.content_type = 'application/json'
+            self.response.write(json.dumps({
+                'sampleRate': rpcstats.STATS_SAMPLE_RATE,
+                'latencyBucketsMs': rpcstats.LATENCY_BUCKETS_MS,
+                'methods': stats,
+                'queryCache': cache_stats}))
+            return
+
+        lookups = cache_stats['hits'] + cache_stats['misses']
+        self.response.write('<p>queryConferences cache: %d hits, %d misses '
+            '(%.0f%% hit rate), %d pages stored, %d evicted.</p>' % (
+            cache_stats['hits'], cache_stats['misses'],
+            100.0 * cache_stats['hits'] / lookups if lookups else 0,
+            cache_stats['stores'], cache_stats['evictions']))
+
+        buckets = ['&le;%d ms' % ms for ms in rpcstats.LATENCY_BUCKETS_MS]
+        buckets.append('&gt;%d ms' % rpcstats.LATENCY_BUCKETS_MS[-1])
+        per_call = rpcstats.METRICS[1:]
+        self.response.write('<p>Sampled calls (rate %s); other columns are '
+            'means per call.</p><table border="1"><tr><th>method</th><th>calls</th>%s%s</tr>' % (
+            rpcstats.STATS_SAMPLE_RATE,
+            ''.join('<th>%s</th>' % metric for metric in per_call),
+            ''.join('<th>%s</th>' % bucket for bucket in buckets)))
+        # slowest methods (by total time) first
+        for name, row in sorted(stats.items(), key=lambda item: -item[1]['ms']):
+            calls = row['calls']
+            self.response.write('<tr><td>%s</td><td>%d</td>%s%s</tr>' % (
+                cgi.escape(name), calls,
+                ''.join('<td>%.1f</td>' % (float(row[metric]) / calls)
+                        for metric in per_call),
+                ''.join('<td>%d</td>' % count for count in row['latency'])))
+        self.response.write('</table><form method="POST">'
+            '<input type="submit" value="Reset"></form>')
+
+    def post(self):
+        """Reset the counters."""
+        rpcstats.resetStats()
+        querycache.resetStats()
+        self.redirect('/admin/stats')
+
+
 app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
     ('/tasks/set_featured_speaker', SetFeaturedSpeakerHandler),
+    ('/tasks/migrate_registrations', MigrateRegistrationsHandler),
+    ('/tasks/migrate_wishlists', MigrateWishlistsHandler),
+    ('/tasks/reconcile_announcement', ReconcileAnnouncementHandler),
+    ('/tasks/reindex_conferences', ReindexConferencesHandler),
+    ('/tasks/rebuild_facets', RebuildFacetsHandler),
+    ('/tasks/import_chunk', ImportChunkHandler),
+    ('/tasks/update_organizer_name', UpdateOrganizerNameHandler),
+    ('/tasks/record_query_stats', RecordQueryStatsHandler),
+    ('/tasks/index_conferences', IndexConferencesHandler),
+    ('/admin/export', ExportHandler),
+    ('/admin/import', ImportFormHandler),
+    ('/admin/import/upload', ImportUploadHandler),
+    ('/admin/import/resume', ImportResumeHandler),
+    ('/admin/stats', StatsHandler),
 ], debug=True)
\ No newline at end of file
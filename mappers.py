@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""mappers.py -- precompiled entity-to-message conversion
+
+A Mapper is built once, at import, for a (Model, Message) pair.  It works
+out which message fields come from which model properties and how each is
+converted (dates and times to strings, by property type), so converting a
+row is a straight run over a tuple of (field name, getter) pairs with no
+per-field hasattr() or name checks.
+
+"""
+
+import operator
+
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import ConferenceForm
+from models import ConferenceSummaryForm
+from models import Profile
+from models import ProfileForm
+from models import Session
+from models import SessionForm
+from models import TeeShirtSize
+from models import Wishlist
+from models import WishlistForm
+
+_STRING_PROPERTIES = (ndb.DateProperty, ndb.TimeProperty, ndb.KeyProperty)
+
+def _str(value):
+    return str(value) if value is not None else None
+
+
+def _converted(getter, convert):
+    return lambda entity: convert(getter(entity))
+
+
+class Mapper(object):
+    """Conversion plan from entities of a Model to a Message class.
+
+    Message fields named like a model property are copied from it, through
+    `convert[name]` if given, else as a string for date, time and key
+    properties.  `computed[name]` derives a field from the whole entity.
+    """
+
+    def __init__(self, model, message, convert=None, computed=None, exclude=()):
+        convert = convert or {}
+        computed = computed or {}
+        properties = model._properties
+        plan = []
+        for field in message.all_fields():
+            name = field.name
+            if name in exclude:
+                continue
+            if name in computed:
+                plan.append((name, computed[name]))
+            elif name in properties:
+                getter = operator.attrgetter(name)
+                if name in convert:
+                    getter = _converted(getter, convert[name])
+                elif isinstance(properties[name], _STRING_PROPERTIES):
+                    getter = _converted(getter, _str)
+                plan.append((name, getter))
+        self.model = model
+        self.message = message
+        self.plan = tuple(plan)
+        self.check = any(field.required for field in message.all_fields())
+
+    def toForm(self, entity, **overrides):
+        """Return the message for an entity; overrides replace fields."""
+        form = self.message()
+        for name, get in self.plan:
+            setattr(form, name, get(entity))
+        for name, value in overrides.items():
+            setattr(form, name, value)
+        if self.check:
+            form.check_initialized()
+        return form
+
+    def toForms(self, entities, **columns):
+        """Return the messages for a list of entities.
+
+        Each keyword is a field name with a list of values, one per entity,
+        that replace the mapped values.
+        """
+        plan = self.plan
+        message = self.message
+        forms = []
+        for entity in entities:
+            form = message()
+            for name, get in plan:
+                setattr(form, name, get(entity))
+            forms.append(form)
+        for name, values in columns.items():
+            for form, value in zip(forms, values):
+                setattr(form, name, value)
+        if self.check:
+            for form in forms:
+                form.check_initialized()
+        return forms
+
+
+def _websafeKey(entity):
+    return entity.key.urlsafe()
+
+
+CONFERENCE = Mapper(Conference, ConferenceForm,
+    computed={'websafeKey': _websafeKey})
+
+SUMMARY = Mapper(Conference, ConferenceSummaryForm,
+    computed={'websafeKey': _websafeKey})
+
+SESSION = Mapper(Session, SessionForm,
+    computed={'websafeKey': _websafeKey})
+
+PROFILE = Mapper(Profile, ProfileForm,
+    convert={'teeShirtSize': lambda size: getattr(TeeShirtSize, size)})
+
+WISHLIST = Mapper(Wishlist, WishlistForm,
+    computed={'websafeSessionKey': lambda wish: wish.sessionKey.urlsafe()},
+    exclude=('userId',))
@@ -17,8 +17,19 @@ class Profile(ndb.Model):
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
+    modified = ndb.DateTimeProperty(auto_now=True, indexed=False)
 
 
+class Registration(ndb.Model):
+    """Registration -- a user's seat at a conference; child of the user's
+    Profile, keyed by the conference's websafe key"""
+    conferenceKey = ndb.KeyProperty()
+
+
+class ConditionalRequest(messages.Message):
+    """ConditionalRequest -- inbound ETag of the copy the client holds"""
+    etag = messages.StringField(1)
+
 class BooleanMessage(messages.Message):
     """BooleanMessage-- outbound Boolean value message"""
     data = messages.BooleanField(1)
@@ -39,6 +50,13 @@ class ProfileForm(messages.Message):
     displayName = messages.StringField(1)
     mainEmail = messages.StringField(2)
     teeShirtSize = messages.EnumField('TeeShirtSize', 3)
+    etag = messages.StringField(4)
+    notModified = messages.BooleanField(5)
+
+
+class ProfileForms(messages.Message):
+    """ProfileForms -- multiple Profile outbound form message"""
+    items = messages.MessageField(ProfileForm, 1, repeated=True)
 
 
 class Conference(ndb.Model):
@@ -53,6 +71,39 @@ class Conference(ndb.Model):
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
+    seatShards      = ndb.IntegerProperty(default=0)
+    organizerDisplayName = ndb.StringProperty(indexed=False)
+
+class AnnouncementState(ndb.Model):
+    """AnnouncementState -- the nearly sold out conferences (singleton)"""
+    conferenceKeys  = ndb.KeyProperty(repeated=True, indexed=False)
+    conferenceNames = ndb.StringProperty(repeated=True, indexed=False)
+    modified        = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+class SeatShard(ndb.Model):
+    """SeatShard -- one slice of a conference's pool of open seats"""
+    seats           = ndb.IntegerProperty(default=0, indexed=False)
+
+class FacetShard(ndb.Model):
+    """FacetShard -- one slice of the conference counts per facet value;
+    while a rebuild runs, also the counts so far and the cursor they reach"""
+    counts          = ndb.JsonProperty(compressed=True)
+    cursor          = ndb.StringProperty(indexed=False)
+
+class SearchPosting(ndb.Model):
+    """SearchPosting -- one shard of a search token's posting list: the
+    conferences containing the token and its weight in each; the first
+    shard also counts the shards"""
+    conferenceKeys  = ndb.KeyProperty(repeated=True, indexed=False)
+    weights         = ndb.IntegerProperty(repeated=True, indexed=False)
+    shardCount      = ndb.IntegerProperty(default=1, indexed=False)
+
+class SearchDocument(ndb.Model):
+    """SearchDocument -- the tokens a conference is indexed under and the
+    posting list shard of each; child of the Conference"""
+    tokens          = ndb.StringProperty(repeated=True, indexed=False)
+    weights         = ndb.IntegerProperty(repeated=True, indexed=False)
+    shards          = ndb.IntegerProperty(repeated=True, indexed=False)
 
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
@@ -68,11 +119,53 @@ class ConferenceForm(messages.Message):
     endDate         = messages.StringField(10)
     websafeKey      = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
-
+    etag            = messages.StringField(13)
+    notModified     = messages.BooleanField(14)
+
+
+class ConferenceSummaryForm(messages.Message):
+    """ConferenceSummaryForm -- the Conference fields shown in listings"""
+    websafeKey      = messages.StringField(1)
+    name            = messages.StringField(2)
+    city            = messages.StringField(3)
+    startDate       = messages.StringField(4)
+    endDate         = messages.StringField(5)
+    topics          = messages.StringField(6, repeated=True)
+    maxAttendees    = messages.IntegerField(7)
+    seatsAvailable  = messages.IntegerField(8)
+    organizerDisplayName = messages.StringField(9)
+
+class QueryPlanForm(messages.Message):
+    """QueryPlanForm -- outbound description of how a query was executed"""
+    pushedFilters = messages.StringField(1, repeated=True)
+    residualFilters = messages.StringField(2, repeated=True)
+    order = messages.StringField(3, repeated=True)
+    scanned = messages.IntegerField(4)
+    returned = messages.IntegerField(5)
 
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextCursor = messages.StringField(2)
+    more = messages.BooleanField(3)
+    plan = messages.MessageField(QueryPlanForm, 4)
+    summaries = messages.MessageField(ConferenceSummaryForm, 5, repeated=True)
+    etag = messages.StringField(6)
+    notModified = messages.BooleanField(7)
+
+class FacetValueForm(messages.Message):
+    """FacetValueForm -- outbound number of conferences with a facet value"""
+    value = messages.StringField(1)
+    count = messages.IntegerField(2)
+
+class ConferenceFacetForm(messages.Message):
+    """ConferenceFacetForm -- outbound counts of one filterable field"""
+    field = messages.StringField(1)
+    values = messages.MessageField(FacetValueForm, 2, repeated=True)
+
+class ConferenceFacetForms(messages.Message):
+    """ConferenceFacetForms -- multiple ConferenceFacetForm outbound form message"""
+    items = messages.MessageField(ConferenceFacetForm, 1, repeated=True)
 
 class ConferenceQueryForm(messages.Message):
     """ConferenceQueryForm -- Conference query inbound form message"""
@@ -83,11 +176,41 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2)
+    cursor = messages.StringField(3)
+    explain = messages.BooleanField(4)
+    view = messages.EnumField('ConferenceView', 5)
+
+class ConferenceSearchForm(messages.Message):
+    """ConferenceSearchForm -- full-text conference search inbound form message"""
+    query = messages.StringField(1)
+    pageSize = messages.IntegerField(2)
+    cursor = messages.StringField(3)
+    view = messages.EnumField('ConferenceView', 4)
+
+class QueryStats(ndb.Model):
+    """QueryStats -- learned filter selectivities of a kind, keyed by kind"""
+    selectivity = ndb.JsonProperty(default={})
+
+
+class ImportJob(ndb.Model):
+    """ImportJob -- progress of a bulk import of an uploaded blob"""
+    blobKey         = ndb.BlobKeyProperty()
+    kind            = ndb.StringProperty()
+    format          = ndb.StringProperty()
+    offset          = ndb.IntegerProperty(default=0)
+    header          = ndb.StringProperty(repeated=True, indexed=False)
+    rowsImported    = ndb.IntegerProperty(default=0)
+    attempt         = ndb.IntegerProperty(default=0)
+    done            = ndb.BooleanProperty(default=False)
+    error           = ndb.TextProperty()
 
 
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     data = messages.StringField(1, required=True)
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3)
 
 
 class Session(ndb.Model):
@@ -101,6 +224,19 @@ class Session(ndb.Model):
     name = ndb.StringProperty(required=True)
     
 
+class SpeakerStats(ndb.Model):
+    """SpeakerStats -- a speaker's sessions at one conference; child of the
+    Conference, keyed by speaker"""
+    sessionCount = ndb.IntegerProperty(default=0)
+    sessionKeys = ndb.KeyProperty(repeated=True, indexed=False)
+    sessionNames = ndb.StringProperty(repeated=True, indexed=False)
+    
+
+class Timetable(ndb.Model):
+    """Timetable -- a conference's sessions in compact, sorted form"""
+    data            = ndb.BlobProperty(compressed=True)
+    sessionCount    = ndb.IntegerProperty(default=0, indexed=False)
+
 class SessionForm(messages.Message):
     """Session Form -- form message outbound"""
     speaker = messages.StringField(3)
@@ -111,11 +247,29 @@ class SessionForm(messages.Message):
     confwebsafeKey      = messages.StringField(8)
     name            = messages.StringField(1)
     highlights     = messages.StringField(2)
+    websafeKey      = messages.StringField(9)
 
 
 class SessionForms(messages.Message):
     """SessionForms multiples outbound"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextCursor = messages.StringField(2)
+    more = messages.BooleanField(3)
+    plan = messages.MessageField(QueryPlanForm, 4)
+
+class SessionQueryFilter(messages.Message):
+    """SessionQueryFilter -- Session query inbound filter message"""
+    field = messages.StringField(1)
+    operator = messages.StringField(2)
+    value = messages.StringField(3)
+
+class SessionQueryForms(messages.Message):
+    """SessionQueryForms -- multiple SessionQueryFilter inbound form message"""
+    websafeConferenceKey = messages.StringField(1)
+    filters = messages.MessageField(SessionQueryFilter, 2, repeated=True)
+    pageSize = messages.IntegerField(3)
+    cursor = messages.StringField(4)
+    explain = messages.BooleanField(5)
 
 class SessionQuery(messages.Message):
     """ Session query inbound form message"""
@@ -137,17 +291,41 @@ class Wishlist(ndb.Model):
     sessionKey          = ndb.KeyProperty()
     typeOfSession            = ndb.StringProperty(repeated=True)
 
+class WishlistSchedule(ndb.Model):
+    """WishlistSchedule -- time spans of a user's wishlisted sessions,
+    sorted by start; child of Profile"""
+    starts          = ndb.IntegerProperty(repeated=True, indexed=False)
+    ends            = ndb.IntegerProperty(repeated=True, indexed=False)
+    maxEnds         = ndb.IntegerProperty(repeated=True, indexed=False)
+    sessionKeys     = ndb.KeyProperty(repeated=True, indexed=False)
+
 class WishlistForm(messages.Message):
     """WishlistForm -- Wishlist outbound form message"""
     sessionName          = messages.StringField(1)
     userId            = messages.StringField(2)
     sessionKey          = messages.StringField(3)
     typeOfSession          = messages.StringField(4, repeated=True)
+    websafeSessionKey          = messages.StringField(5)
+    conflictingSessionKeys = messages.StringField(6, repeated=True)
 
 class WishlistForms(messages.Message):
     """WishlistForms -- multiple Wishlist outbound form message"""
     items = messages.MessageField(WishlistForm, 1, repeated=True)
 
+class WishlistConflictForm(messages.Message):
+    """WishlistConflictForm -- two wishlisted sessions that overlap"""
+    websafeSessionKeys = messages.StringField(1, repeated=True)
+    overlapStart = messages.StringField(2)
+    overlapEnd = messages.StringField(3)
+
+class WishlistConflictForms(messages.Message):
+    """WishlistConflictForms -- multiple WishlistConflictForm outbound form message"""
+    items = messages.MessageField(WishlistConflictForm, 1, repeated=True)
+
+class WishlistBatchForm(messages.Message):
+    """WishlistBatchForm -- sessions to add to the wishlist inbound form message"""
+    websafeSessionKeys = messages.StringField(1, repeated=True)
+
 class WishlistQuery(messages.Message):
     """WishlistQueryForm -- WishlistQuery inbound form message"""
     userId = messages.StringField(1)
@@ -176,4 +354,9 @@ class TeeShirtSize(messages.Enum):
     XXL_M = 12
     XXL_W = 13
     XXXL_M = 14
-    XXXL_W = 15
\ No newline at end of file
+    XXXL_W = 15
+
+class ConferenceView(messages.Enum):
+    """ConferenceView -- listing detail level enumeration value"""
+    FULL = 1
+    SUMMARY = 2
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+"""planner.py -- small query planner for filtered, paged datastore queries
+
+The datastore allows inequality filters on only one property per query and
+needs a composite index for every filter combination.  Instead, the planner
+pushes a single filter group (one equality filter, or the range filters on
+one property) to the datastore and evaluates every other filter, including
+NE, IN, NOT IN and further inequalities, in memory on the streamed results.  The pushed
+group is the one with the lowest estimated selectivity; estimates are
+learned from the pass rates of in-memory filters and kept in a QueryStats
+entity per kind, updated from a task so that query latency never waits
+on it.  The chosen group is recorded in the cursors a plan hands out, and
+a continuation request reuses it instead of planning again, so a page
+boundary never falls between two different queries.
+
+Filters are dicts with 'field', 'operator' and 'value' keys, as produced by
+ConferenceApi._formatFilters() and _formatSessionFilters(); the value of
+an IN or NOT IN filter is a list.
+
+"""
+
+import hashlib
+import json
+import operator
+import random
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import QueryStats
+
+MEMCACHE_STATS_KEY = "QUERY_STATS:%s"
+STATS_SAMPLE_RATE = 0.05
+STATS_SMOOTHING = 0.2
+BATCH_SIZE = 50
+STATS_TASK_URL = '/tasks/record_query_stats'
+MAX_SCAN = 1000
+
+RANGE_OPERATORS = ('<', '<=', '>', '>=')
+
+# selectivity assumed for a filter until it has been observed
+DEFAULT_SELECTIVITY = {
+    '=': 0.1,
+    '<': 0.5,
+    '<=': 0.5,
+    '>': 0.5,
+    '>=': 0.5,
+    '!=': 0.9,
+    'IN': 0.3,
+    'NOT IN': 0.9,
+}
+
+COMPARATORS = {
+    '=': operator.eq,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '!=': operator.ne,
+    'IN': lambda value, values: value in values,
+}
+
+
+class InvalidCursor(Exception):
+    """Raised when a cursor does not belong to the planned query."""
+
+
+def describe(filtr):
+    """Return a readable form of a filter, e.g. 'city = London'."""
+    value = filtr['value']
+    if isinstance(value, list):
+        value = '(%s)' % ', '.join(map(unicode, value))
+    return u'%s %s %s' % (filtr['field'], filtr['operator'], value)
+
+
+def _statKey(filtr):
+    return '%s %s' % (filtr['field'], filtr['operator'])
+
+
+def _candidateToken(filtr):
+    """Name the candidate a filter belongs to by its content, so the same
+    filters sent in any order give the same names."""
+    if filtr['operator'] == '=':
+        return 'eq-' + hashlib.sha1(describe(filtr).encode('utf-8')).hexdigest()[:16]
+    return 'range-' + filtr['field']
+
+
+def matches(entity, filtr):
+    """Evaluate a filter against an entity the way the datastore would.
+
+    A repeated property matches if any of its values does, except for NOT
+    IN, which matches only if none of its values is in the list.
+    """
+    values = getattr(entity, filtr['field'], None)
+    if not isinstance(values, list):
+        values = [values]
+    if filtr['operator'] == 'NOT IN':
+        return not any(v in filtr['value'] for v in values)
+    compare = COMPARATORS[filtr['operator']]
+    return any(v is not None and compare(v, filtr['value']) for v in values)
+
+
+def getStats(kind):
+    """Return the learned selectivities of a kind as a dict."""
+    stats = memcache.get(MEMCACHE_STATS_KEY % kind)
+    if stats is None:
+        entity = QueryStats.get_by_id(kind)
+        stats = entity.selectivity if entity else {}
+        memcache.set(MEMCACHE_STATS_KEY % kind, stats)
+    return stats
+
+
+@ndb.transactional()
+def updateStats(kind, observations):
+    """Fold observed (evaluated, passed) counts into the QueryStats entity;
+    run by the record_query_stats task."""
+    entity = QueryStats.get_by_id(kind) or QueryStats(id=kind, selectivity={})
+    for key, (evaluated, passed) in observations.items():
+        observed = float(passed) / evaluated
+        previous = entity.selectivity.get(key)
+        if previous is None:
+            entity.selectivity[key] = observed
+        else:
+            entity.selectivity[key] = ((1 - STATS_SMOOTHING) * previous +
+                                       STATS_SMOOTHING * observed)
+    entity.put()
+    ndb.get_context().call_on_commit(
+        lambda: memcache.set(MEMCACHE_STATS_KEY % kind, entity.selectivity))
+
+
+def recordStats(kind, observations):
+    """Sample observed pass rates into the kind's statistics.
+
+    Only a fraction of executions record them, and the write happens in a
+    task, so the stats entity is neither a write hot spot nor on the
+    request path.
+    """
+    observations = dict((k, v) for k, v in observations.items() if v[0])
+    if observations and random.random() < STATS_SAMPLE_RATE:
+        taskqueue.add(url=STATS_TASK_URL, params={
+            'kind': kind, 'observations': json.dumps(observations)})
+
+
+class QueryPlan(object):
+    """A datastore query for the pushed filters plus in-memory filters."""
+
+    def __init__(self, model, pushed, residual, order, token):
+        self.model = model
+        self.pushed = pushed
+        self.residual = residual
+        self.order = order
+        # names the pushed group in the cursors handed out
+        self.token = token
+
+    def query(self, ancestor=None):
+        """Return the ndb query that streams candidate entities."""
+        q = self.model.query(ancestor=ancestor)
+        for filtr in self.pushed:
+            # comparing the model's property converts the value as the
+            # property stores it (e.g. a time to a datetime)
+            prop = (self.model._properties.get(filtr['field']) or
+                    ndb.GenericProperty(filtr['field']))
+            q = q.filter(COMPARATORS[filtr['operator']](prop, filtr['value']))
+        for field in self.order:
+            q = q.order(ndb.GenericProperty(field))
+        return q
+
+    def explain(self):
+        """Return (pushed, residual, order) as lists of readable strings."""
+        return ([describe(f) for f in self.pushed],
+                [describe(f) for f in self.residual],
+                list(self.order))
+
+    def execute(self, page_size, cursor=None, ancestor=None, max_scan=MAX_SCAN,
+                keys_only=False):
+        """Fetch one page of matching entities.
+
+        Rows are streamed in batches and filtered in memory; scanning stops
+        once the page is full or max_scan rows have been read, in which case
+        the returned cursor resumes the scan.  Return
+        (entities, nextCursor, more, scanned).
+
+        keys_only returns keys instead of entities and needs a plan with no
+        residual filters.
+        """
+        if keys_only and self.residual:
+            raise ValueError('residual filters need the entities')
+        try:
+            start_cursor = None
+            if cursor:
+                token, _, cursor = cursor.partition('.')
+                if token != self.token:
+                    raise InvalidCursor()
+                start_cursor = ndb.Cursor(urlsafe=cursor)
+            it = self.query(ancestor).iter(start_cursor=start_cursor,
+                produce_cursors=True, batch_size=min(BATCH_SIZE, max_scan),
+                keys_only=keys_only)
+            results = []
+            scanned = 0
+            observations = dict((_statKey(f), [0, 0]) for f in self.residual)
+            for entity in it:
+                scanned += 1
+                for filtr in self.residual:
+                    observation = observations[_statKey(filtr)]
+                    observation[0] += 1
+                    if not matches(entity, filtr):
+                        break
+                    observation[1] += 1
+                else:
+                    results.append(entity)
+                if len(results) >= page_size or scanned >= max_scan:
+                    break
+            more = bool(scanned) and it.has_next()
+            next_cursor = '%s.%s' % (self.token, it.cursor_after().urlsafe()) if more else None
+        except (datastore_errors.BadValueError, datastore_errors.BadRequestError):
+            raise InvalidCursor()
+        recordStats(self.model._get_kind(), observations)
+        return results, next_cursor, more, scanned
+
+
+def plan(model, filters, stats, order=('name',), pushable=None, cursor=None):
+    """Choose which filters to push to the datastore.
+
+    Candidates are each equality filter and the group of range filters on
+    each field; NE, IN and NOT IN are always evaluated in memory (IN would
+    split the query into one per value, which cannot be paged with a
+    cursor).  `pushable` optionally
+    limits the fields that have an index to push to.  The candidate with
+    the lowest estimated selectivity is pushed, and the query is ordered by
+    the range field (if any) followed by `order`.
+
+    Given a cursor from an earlier page, the candidate named in it is
+    pushed again whatever the stats now say; raise InvalidCursor if it
+    names no candidate of these filters.
+    """
+    def selectivity(filtr):
+        return stats.get(_statKey(filtr), DEFAULT_SELECTIVITY[filtr['operator']])
+
+    candidates = {}
+    for filtr in filters:
+        if pushable is not None and filtr['field'] not in pushable:
+            continue
+        if filtr['operator'] == '=' or filtr['operator'] in RANGE_OPERATORS:
+            group = candidates.setdefault(_candidateToken(filtr), [])
+            if filtr not in group:
+                group.append(filtr)
+    for group in candidates.values():
+        group.sort(key=describe)
+
+    def estimate(token):
+        product = 1.0
+        for filtr in candidates[token]:
+            product *= selectivity(filtr)
+        return product
+
+    if cursor:
+        token = cursor.partition('.')[0]
+        if token != 'all' and token not in candidates:
+            raise InvalidCursor()
+    elif candidates:
+        token = min(sorted(candidates), key=estimate)
+    else:
+        token = 'all'
+    pushed = candidates.get(token, [])
+    residual = sorted((f for f in filters if f not in pushed),
+                      key=lambda f: (selectivity(f), describe(f)))
+    order = list(order)
+    if pushed and pushed[0]['operator'] != '=':
+        order.insert(0, pushed[0]['field'])
+    return QueryPlan(model, pushed, residual, order, token)
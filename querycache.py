@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""querycache.py -- bounded memcache cache of query result pages
+
+A query is identified by a hash of its canonical form.  Cached pages live
+in a fixed set of MAX_ENTRIES slots, chosen by the hash, so the cache
+never holds more than MAX_ENTRIES pages however many distinct queries
+arrive; a query takes over an occupied slot only when it misses twice in
+a row there, so one-off queries do not evict the popular ones.
+
+Every entry is stamped with the global conference generation read before
+the query ran.  Conference writes bump the generation, which makes every
+older entry a miss without deleting anything.  A lookup is a single
+memcache get_multi.
+
+"""
+
+import collections
+import hashlib
+import json
+import time
+
+from google.appengine.api import memcache
+
+MEMCACHE_GENERATION_KEY = "CONFERENCE_GENERATION"
+MEMCACHE_ENTRY_KEY = "QUERY_CACHE:%d"
+MEMCACHE_SEEN_KEY = "QUERY_CACHE_SEEN:%d"
+MEMCACHE_STATS_KEY = "QUERY_CACHE_STATS:%s"
+MAX_ENTRIES = 256
+CACHE_TTL = 600
+
+STATS = ('hits', 'misses', 'stores', 'evictions')
+
+# what put() needs to know about a miss
+Miss = collections.namedtuple('Miss', 'queryHash slot generation seen occupied')
+
+
+def queryHash(*parts):
+    """Return a hash of the JSON-serializable parts of a query; callers
+    put them in canonical form (e.g. filters sorted)."""
+    return hashlib.sha1(json.dumps(parts, sort_keys=True)).hexdigest()
+
+
+def bumpGeneration():
+    """Invalidate every cached page; call after conferences are written."""
+    memcache.incr(MEMCACHE_GENERATION_KEY, initial_value=int(time.time() * 1000))
+
+
+def get(query_hash):
+    """Return (value, miss): the cached value of a query and None, or None
+    and a Miss to hand to put() with the freshly computed value."""
+    slot = int(query_hash, 16) % MAX_ENTRIES
+    entry_key = MEMCACHE_ENTRY_KEY % slot
+    seen_key = MEMCACHE_SEEN_KEY % slot
+    cached = memcache.get_multi([MEMCACHE_GENERATION_KEY, entry_key, seen_key])
+    generation = cached.get(MEMCACHE_GENERATION_KEY)
+    if generation is None:
+        memcache.add(MEMCACHE_GENERATION_KEY, int(time.time() * 1000))
+        generation = memcache.get(MEMCACHE_GENERATION_KEY)
+
+    entry = cached.get(entry_key)
+    if entry and entry[0] == generation and entry[1] == query_hash:
+        # counted the same way as misses, so the hit rate is not skewed
+        memcache.offset_multi({MEMCACHE_STATS_KEY % 'hits': 1}, initial_value=0)
+        return entry[2], None
+    occupied = bool(entry) and entry[0] == generation
+    return None, Miss(query_hash, slot, generation,
+                      cached.get(seen_key) == query_hash, occupied)
+
+
+def put(miss, value):
+    """Count a miss from get() and cache the value if the query has earned
+    its slot: the slot is free or the query missed there just before."""
+    counts = {MEMCACHE_STATS_KEY % 'misses': 1}
+    if miss.generation is not None:
+        if miss.seen or not miss.occupied:
+            memcache.set(MEMCACHE_ENTRY_KEY % miss.slot,
+                (miss.generation, miss.queryHash, value), time=CACHE_TTL)
+            counts[MEMCACHE_STATS_KEY % 'stores'] = 1
+            if miss.occupied:
+                counts[MEMCACHE_STATS_KEY % 'evictions'] = 1
+        else:
+            memcache.set(MEMCACHE_SEEN_KEY % miss.slot, miss.queryHash,
+                time=CACHE_TTL)
+    memcache.offset_multi(counts, initial_value=0)
+
+
+def getStats():
+    """Return the hit, miss, store and eviction counts since the last
+    reset."""
+    counts = memcache.get_multi([MEMCACHE_STATS_KEY % name for name in STATS])
+    return dict((name, counts.get(MEMCACHE_STATS_KEY % name, 0)) for name in STATS)
+
+
+def resetStats():
+    """Zero the counts."""
+    memcache.delete_multi([MEMCACHE_STATS_KEY % name for name in STATS])
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+"""rpcstats.py -- RPC and latency measurement for API methods
+
+Methods wrapped in @measured are sampled (STATS_SAMPLE_RATE of calls): the
+wall time, datastore gets, queries and puts, memcache hits and misses, task
+enqueues and time spent waiting on each service are added to counters in
+memcache, along with a latency histogram per method.  getStats() reads them
+back for the /admin/stats page.  The counters are approximate: memcache may
+evict some of them.
+
+With MEASURE_RPC_DEPTH on, every call also logs how many RPCs it made and
+the depth of its critical path: the number of sequential rounds, where an
+RPC issued while another is still in flight joins the current round instead
+of starting a new one.
+
+gather() runs independent RPCs in parallel, or one after the other when
+PARALLEL_RPCS is off, so the same code reports its depth both ways.
+
+recording() counts the RPCs made inside a block, e.g. by benchmark.py.
+
+"""
+
+import bisect
+import collections
+import contextlib
+import functools
+import logging
+import random
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+MEASURE_RPC_DEPTH = False
+PARALLEL_RPCS = True
+STATS_SAMPLE_RATE = 0.1
+
+MEMCACHE_STATS_KEY = "RPCSTATS:%s:%s"
+# upper bounds of the latency histogram buckets; the last bucket is open
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+METRICS = ('calls', 'ms', 'rpcs', 'datastore_gets', 'datastore_queries',
+           'datastore_puts', 'memcache_hits', 'memcache_misses', 'task_adds',
+           'datastore_v3_ms', 'memcache_ms', 'taskqueue_ms')
+
+# names of the methods wrapped in @measured
+MEASURED = []
+
+_state = threading.local()
+
+
+class RpcDepth(object):
+    """Counts RPCs, sequential rounds of RPCs and what the RPCs did."""
+
+    def __init__(self):
+        self.rpcs = 0
+        self.depth = 0
+        self.inflight = 0
+        self.calls = collections.Counter()
+        self.metrics = collections.Counter()
+        self.started_at = {}
+
+    def started(self, service, call, request):
+        self.rpcs += 1
+        self.calls['%s.%s' % (service, call)] += 1
+        self.started_at[id(request)] = time.time()
+        if not self.inflight:
+            self.depth += 1
+        self.inflight += 1
+
+    def finished(self, service, call, request, response):
+        self.inflight = max(self.inflight - 1, 0)
+        started = self.started_at.pop(id(request), None)
+        if started is not None:
+            self.metrics['%s_ms' % service] += (time.time() - started) * 1000
+        if response is None:
+            return
+        if service == 'datastore_v3':
+            if call == 'Get':
+                self.metrics['datastore_gets'] += request.key_size()
+            elif call == 'RunQuery':
+                self.metrics['datastore_queries'] += 1
+            elif call == 'Put':
+                self.metrics['datastore_puts'] += request.entity_size()
+        elif service == 'memcache' and call == 'Get':
+            hits = response.item_size()
+            self.metrics['memcache_hits'] += hits
+            self.metrics['memcache_misses'] += request.key_size() - hits
+        elif service == 'taskqueue' and call == 'BulkAdd':
+            self.metrics['task_adds'] += request.add_request_size()
+
+
+def _preCall(service, call, request, response, rpc=None):
+    recorder = getattr(_state, 'recorder', None)
+    if recorder:
+        recorder.started(service, call, request)
+
+
+def _postCall(service, call, request, response, rpc=None, error=None):
+    recorder = getattr(_state, 'recorder', None)
+    if recorder:
+        recorder.finished(service, call, request, None if error else response)
+
+
+_hooked_apiproxy = None
+
+
+def _installHooks():
+    # testbed swaps in a fresh apiproxy on activation, so the hooks are
+    # installed on whichever one is current
+    global _hooked_apiproxy
+    if _hooked_apiproxy is not apiproxy_stub_map.apiproxy:
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'rpcstats_depth', _preCall)
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'rpcstats_depth', _postCall)
+        _hooked_apiproxy = apiproxy_stub_map.apiproxy
+
+
+@contextlib.contextmanager
+def recording():
+    """Record the RPCs made in this thread inside the block; yields the
+    RpcDepth."""
+    _installHooks()
+    previous = getattr(_state, 'recorder', None)
+    _state.recorder = recorder = RpcDepth()
+    try:
+        yield recorder
+    finally:
+        _state.recorder = previous
+
+
+def _statKey(name, metric):
+    return MEMCACHE_STATS_KEY % (name, metric)
+
+
+def _bucketKey(name, index):
+    return _statKey(name, 'latency%d' % index)
+
+
+def _addStats(name, recorder, elapsed_ms):
+    """Add one sampled call to the method's counters in memcache."""
+    metrics = recorder.metrics
+    metrics['calls'] = 1
+    metrics['ms'] = elapsed_ms
+    metrics['rpcs'] = recorder.rpcs
+    deltas = dict((_statKey(name, metric), int(round(value)))
+                  for metric, value in metrics.items() if value)
+    deltas[_bucketKey(name, bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms))] = 1
+    memcache.offset_multi(deltas, initial_value=0)
+
+
+def getStats():
+    """Return {method name: {metric: total, 'latency': bucket counts}}
+    for every measured method that has been sampled."""
+    keys = []
+    for name in MEASURED:
+        keys.extend(_statKey(name, metric) for metric in METRICS)
+        keys.extend(_bucketKey(name, i) for i in range(len(LATENCY_BUCKETS_MS) + 1))
+    values = memcache.get_multi(keys)
+    stats = {}
+    for name in MEASURED:
+        if not values.get(_statKey(name, 'calls')):
+            continue
+        stats[name] = dict((metric, values.get(_statKey(name, metric), 0))
+                           for metric in METRICS)
+        stats[name]['latency'] = [values.get(_bucketKey(name, i), 0)
+                                  for i in range(len(LATENCY_BUCKETS_MS) + 1)]
+    return stats
+
+
+def resetStats():
+    """Drop the counters of every measured method."""
+    keys = []
+    for name in MEASURED:
+        keys.extend(_statKey(name, metric) for metric in METRICS)
+        keys.extend(_bucketKey(name, i) for i in range(len(LATENCY_BUCKETS_MS) + 1))
+    memcache.delete_multi(keys)
+
+
+def measured(method):
+    """Sample the latency and RPC counts of an API method into memcache,
+    and log its critical-path depth when MEASURE_RPC_DEPTH is on."""
+    MEASURED.append(method.__name__)
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        sampled = random.random() < STATS_SAMPLE_RATE
+        if not (sampled or MEASURE_RPC_DEPTH):
+            return method(*args, **kwargs)
+        start = time.time()
+        with recording() as recorder:
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed_ms = (time.time() - start) * 1000
+                if MEASURE_RPC_DEPTH:
+                    logging.info('%s: %d RPCs, critical-path depth %d (%s)',
+                        method.__name__, recorder.rpcs, recorder.depth,
+                        'parallel' if PARALLEL_RPCS else 'sequential')
+                if sampled:
+                    _addStats(method.__name__, recorder, elapsed_ms)
+    return wrapper
+
+
+@ndb.tasklet
+def gather(*thunks):
+    """Call each thunk to start an RPC and return all their results.
+
+    The thunks return futures (or lists of futures).  They are all started
+    before any is waited on, unless PARALLEL_RPCS is off.
+    """
+    if PARALLEL_RPCS:
+        results = yield [thunk() for thunk in thunks]
+    else:
+        results = []
+        for thunk in thunks:
+            result = yield thunk()
+            results.append(result)
+    raise ndb.Return(results)
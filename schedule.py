@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+"""schedule.py -- per-user interval index of wishlisted sessions
+
+Each user's WishlistSchedule is a child of their Profile, in the same
+entity group as their Wishlist entries, and is written in the same
+transactions.  It holds the time span of every wishlisted session that has
+a date and start time, as minutes since the epoch, sorted by start, with
+the running maximum of the ends.  A new session's conflicts are found by
+two binary searches instead of loading and sorting all the wishlisted
+sessions.
+
+"""
+
+import bisect
+import heapq
+from datetime import datetime
+from datetime import timedelta
+
+from google.appengine.ext import ndb
+
+from models import Wishlist
+from models import WishlistSchedule
+
+SCHEDULE_ID = 'schedule'
+EPOCH = datetime(1970, 1, 1)
+
+
+def scheduleKey(p_key):
+    """Return the key of the WishlistSchedule of the given Profile key."""
+    return ndb.Key(WishlistSchedule, SCHEDULE_ID, parent=p_key)
+
+
+def span(session):
+    """Return a session's (start, end) in minutes since the epoch, or None
+    if it has no date or start time.  A session without a duration counts
+    as one minute long."""
+    if not session.date or not session.startTime:
+        return None
+    start = datetime.combine(session.date, session.startTime) - EPOCH
+    start = start.days * 24 * 60 + start.seconds // 60
+    return start, start + max(session.duration or 0, 1)
+
+
+def toDatetime(minutes):
+    return EPOCH + timedelta(minutes=minutes)
+
+
+def conflicts(schedule, start, end):
+    """Return the session keys whose spans overlap [start, end).
+
+    Spans are sorted by start, so the candidates are those starting before
+    `end`; the running maximum of the ends skips every earlier span that
+    finished by `start`.
+    """
+    hi = bisect.bisect_left(schedule.starts, end)
+    lo = bisect.bisect_right(schedule.maxEnds, start, 0, hi)
+    return [schedule.sessionKeys[i] for i in range(lo, hi)
+            if schedule.ends[i] > start]
+
+
+def _updateMaxEnds(schedule, i):
+    """Recompute the running maximum of the ends from position i on."""
+    del schedule.maxEnds[i:]
+    for end in schedule.ends[i:]:
+        schedule.maxEnds.append(max(end, schedule.maxEnds[-1]) if schedule.maxEnds else end)
+
+
+def insert(schedule, s_key, start, end):
+    """Add a session's span to the schedule, keeping it sorted."""
+    i = bisect.bisect_right(schedule.starts, start)
+    schedule.starts.insert(i, start)
+    schedule.ends.insert(i, end)
+    schedule.sessionKeys.insert(i, s_key)
+    _updateMaxEnds(schedule, i)
+
+
+def remove(schedule, s_key):
+    """Drop a session's span from the schedule, if it has one."""
+    if s_key in schedule.sessionKeys:
+        i = schedule.sessionKeys.index(s_key)
+        del schedule.starts[i], schedule.ends[i], schedule.sessionKeys[i]
+        _updateMaxEnds(schedule, i)
+
+
+def overlaps(schedule):
+    """Return every overlapping pair of spans as (first key, second key,
+    overlap start, overlap end), sweeping the spans in start order."""
+    pairs = []
+    active = []  # heap of (end, index) of spans that started earlier
+    for i, (start, end) in enumerate(zip(schedule.starts, schedule.ends)):
+        while active and active[0][0] <= start:
+            heapq.heappop(active)
+        for other_end, j in sorted(active, key=lambda a: a[1]):
+            pairs.append((schedule.sessionKeys[j], schedule.sessionKeys[i],
+                          start, min(end, other_end)))
+        heapq.heappush(active, (end, i))
+    return pairs
+
+
+def build(p_key):
+    """Return a new schedule for a user whose wishlist predates schedules,
+    from their Wishlist entries; the caller puts it.  Run it in the
+    transaction that puts it, so that no entry added meanwhile is missed.
+    """
+    wishes = Wishlist.query(ancestor=p_key).fetch()
+    schedule = WishlistSchedule(key=scheduleKey(p_key))
+    s_keys = [wish.sessionKey for wish in wishes]
+    for s_key, session in zip(s_keys, _getSessions(s_keys)):
+        session_span = span(session) if session else None
+        if session_span:
+            insert(schedule, s_key, *session_span)
+    return schedule
+
+
+@ndb.non_transactional
+def _getSessions(s_keys):
+    """Read sessions outside the transaction; they belong to their
+    conferences' entity groups, not the user's."""
+    return ndb.get_multi(s_keys)
+
+
+@ndb.transactional()
+def ensure(p_key):
+    """Make sure the user has a schedule; return it."""
+    schedule = scheduleKey(p_key).get()
+    if not schedule:
+        schedule = build(p_key)
+        schedule.put()
+    return schedule
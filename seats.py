@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+"""seats.py -- sharded seat counter for conference registration
+
+Each conference's open seats are split across up to NUM_SHARDS root
+SeatShard entities, so concurrent registrations write to different entity
+groups instead of all rewriting the Conference.  The aggregate count is
+cached in memcache and adjusted in place as seats are taken or released.
+
+"""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import SeatShard
+
+NUM_SHARDS = 20
+MEMCACHE_SEATS_KEY = "SEATS_AVAILABLE:%s"
+SEATS_CACHE_TTL = 60
+
+
+class NoSeatsAvailable(Exception):
+    """Raised when every shard of a conference's seat pool is empty."""
+
+
+def _shardKey(conf_key, index):
+    """Return the key of shard `index` for the given conference key."""
+    return ndb.Key(SeatShard, '%s:%d' % (conf_key.urlsafe(), index))
+
+
+def _shardKeys(conf):
+    """Return the keys of all shards of the given conference."""
+    return [_shardKey(conf.key, i) for i in range(conf.seatShards)]
+
+
+def _cacheKey(conf_key):
+    return MEMCACHE_SEATS_KEY % conf_key.urlsafe()
+
+
+def initSeats(conf, seats):
+    """Spread `seats` over the conference's shards and return the shards.
+
+    Sets conf.seatShards; the caller is responsible for putting both the
+    conference and the returned shards.
+    """
+    num_shards = max(1, min(NUM_SHARDS, seats))
+    conf.seatShards = num_shards
+    per_shard, extra = divmod(max(seats, 0), num_shards)
+    return [SeatShard(key=_shardKey(conf.key, i),
+                      seats=per_shard + (1 if i < extra else 0))
+            for i in range(num_shards)]
+
+
+def ensureSeats(conf):
+    """Create the shards of a conference created before seats were sharded.
+
+    The pool is seeded from the denormalized Conference.seatsAvailable.
+    The Conference is read again in the transaction that creates the
+    shards, so concurrent first registrations seed the pool only once and
+    never write back a stale Conference.  conf.seatShards is set either
+    way.  Return True if the shards were created now.
+    """
+    if conf.seatShards:
+        return False
+    conf.seatShards, created = _createShards(conf.key)
+    return created
+
+
+@ndb.transactional(xg=True)
+def _createShards(conf_key):
+    """Seed the shards of a conference unless another request has;
+    return (seatShards, created)."""
+    conf = conf_key.get()
+    if conf.seatShards:
+        return conf.seatShards, False
+    shards = initSeats(conf, conf.seatsAvailable or 0)
+    ndb.put_multi(shards + [conf])
+    return conf.seatShards, True
+
+
+def adjustSeats(conf, delta):
+    """Add `delta` (possibly negative) seats to one shard of the pool.
+
+    Must run inside a transaction that may span another entity group.
+    """
+    if not delta:
+        return
+    shard = _shardKey(conf.key, random.randrange(conf.seatShards)).get()
+    shard.seats += delta
+    shard.put()
+    ndb.get_context().call_on_commit(lambda: memcache.delete(_cacheKey(conf.key)))
+
+
+def pickShard(conf):
+    """Return the key of a random shard that had open seats at read time.
+
+    The read is outside any transaction; takeSeat() re-checks the shard.
+    Raise NoSeatsAvailable if every shard is empty.
+    """
+    shards = [s for s in ndb.get_multi(_shardKeys(conf)) if s and s.seats > 0]
+    if not shards:
+        raise NoSeatsAvailable()
+    return random.choice(shards).key
+
+
+def takeSeat(conf, shard_key):
+    """Take one seat from the given shard; must run inside a transaction.
+
+    Return False if the shard has been emptied since pickShard().
+    """
+    shard = shard_key.get()
+    if not shard or shard.seats <= 0:
+        return False
+    shard.seats -= 1
+    shard.put()
+    ndb.get_context().call_on_commit(lambda: memcache.decr(_cacheKey(conf.key)))
+    return True
+
+
+def releaseSeat(conf):
+    """Give one seat back to a random shard; must run inside a transaction."""
+    shard = _shardKey(conf.key, random.randrange(conf.seatShards)).get()
+    shard.seats += 1
+    shard.put()
+    ndb.get_context().call_on_commit(lambda: memcache.incr(_cacheKey(conf.key)))
+
+
+def getSeatsAvailable(conf):
+    """Return the number of open seats of a conference."""
+    return getSeatsAvailableMulti([conf])[conf.key]
+
+
+def getSeatsAvailableMulti(confs):
+    """Return a dict of conference key -> open seats."""
+    return getSeatsAvailableMultiAsync(confs).get_result()
+
+
+@ndb.tasklet
+def getSeatsAvailableMultiAsync(confs):
+    """Return a future for a dict of conference key -> open seats.
+
+    Counts are read from memcache in one batch; misses are summed from the
+    shards with a single get_multi and written back to memcache.
+    Conferences whose shards were never created fall back to the
+    denormalized Conference.seatsAvailable.
+    """
+    ctx = ndb.get_context()
+    counts = {}
+    sharded = [conf for conf in confs if conf.seatShards]
+    for conf in confs:
+        if not conf.seatShards:
+            counts[conf.key] = conf.seatsAvailable or 0
+
+    cached = yield [ctx.memcache_get(_cacheKey(conf.key)) for conf in sharded]
+    missing = []
+    for conf, count in zip(sharded, cached):
+        if count is None:
+            missing.append(conf)
+        else:
+            counts[conf.key] = count
+
+    if missing:
+        keys = []
+        for conf in missing:
+            keys.extend(_shardKeys(conf))
+        shards = yield ndb.get_multi_async(keys)
+        shards = dict(zip(keys, shards))
+        to_cache = []
+        for conf in missing:
+            total = sum(shards[key].seats for key in _shardKeys(conf) if shards[key])
+            counts[conf.key] = max(total, 0)
+            to_cache.append(ctx.memcache_set(_cacheKey(conf.key), counts[conf.key],
+                time=SEATS_CACHE_TTL))
+        yield to_cache
+
+    raise ndb.Return(counts)
@@ -130,3 +130,41 @@ app.factory('oauth2Provider', function ($modal) {
 
     return oauth2Provider;
 });
+
+
+/**
+ * @ngdoc service
+ * @name etagCache
+ *
+ * @description
+ * Keeps the last response of the conference API methods that take an ETag (getConference,
+ * getConferencesToAttend, getProfile, getAnnouncement), sends its ETag with the next call and
+ * hands back the kept response when the server answers notModified.
+ *
+ */
+app.factory('etagCache', function () {
+    var etagCache = {};
+    var entries = {};
+
+    /**
+     * Invokes the conference API method with the params and calls back with its response, or with
+     * the kept response if it has not been modified.
+     */
+    etagCache.execute = function (method, params, callback) {
+        var key = method + ' ' + JSON.stringify(params || {});
+        var entry = entries[key];
+        var sendParams = angular.extend({}, params, entry ? {etag: entry.etag} : {});
+        gapi.client.conference[method](sendParams).execute(function (resp) {
+            if (!resp.error && resp.notModified && entry) {
+                callback(entry.resp);
+                return;
+            }
+            if (!resp.error && resp.etag) {
+                entries[key] = {etag: resp.etag, resp: resp};
+            }
+            callback(resp);
+        });
+    };
+
+    return etagCache;
+});
@@ -25,7 +25,7 @@ conferenceApp.controllers = angular.module('conferenceControllers', ['ui.bootstr
  * A controller used for the My Profile page.
  */
 conferenceApp.controllers.controller('MyProfileCtrl',
-    function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+    function ($scope, $log, oauth2Provider, etagCache, HTTP_ERRORS) {
         $scope.submitted = false;
         $scope.loading = false;
 
@@ -63,8 +63,8 @@ conferenceApp.controllers.controller('MyProfileCtrl',
             var retrieveProfileCallback = function () {
                 $scope.profile = {};
                 $scope.loading = true;
-                gapi.client.conference.getProfile().
-                    execute(function (resp) {
+                etagCache.execute('getProfile', {},
+                    function (resp) {
                         $scope.$apply(function () {
                             $scope.loading = false;
                             if (resp.error) {
@@ -249,7 +249,7 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
  * @description
  * A controller used for the Show conferences page.
  */
-conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, oauth2Provider, etagCache, HTTP_ERRORS) {
 
     /**
      * Holds the status if the query is being executed.
@@ -266,6 +266,12 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
     $scope.filters = [
     ];
 
+    /**
+     * Holds the words to search conference names and descriptions for.
+     * @type {string}
+     */
+    $scope.searchText = '';
+
     $scope.filtereableFields = [
         {enumValue: 'CITY', displayName: 'City'},
         {enumValue: 'TOPIC', displayName: 'Topic'},
@@ -306,6 +312,32 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
     $scope.tabAllSelected = function () {
         $scope.selectedTab = 'ALL';
         $scope.queryConferences();
+        $scope.getConferenceFacets();
+    };
+
+    /**
+     * Holds the number of conferences per value of each filterable field, keyed by the field's enumValue.
+     * @type {Object}
+     */
+    $scope.facets = {};
+
+    /**
+     * Invokes the conference.getConferenceFacets method to show the counts next to the filters.
+     */
+    $scope.getConferenceFacets = function () {
+        gapi.client.conference.getConferenceFacets().
+            execute(function (resp) {
+                $scope.$apply(function () {
+                    if (resp.error) {
+                        $log.error('Failed to get the conference facets : ' + (resp.error.message || ''));
+                    } else {
+                        $scope.facets = {};
+                        angular.forEach(resp.items, function (facet) {
+                            $scope.facets[facet.field] = facet.values || [];
+                        });
+                    }
+                });
+            });
     };
 
     /**
@@ -341,32 +373,66 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
 
     /**
      * Namespace for the pagination.
+     * Pages are fetched from the server one at a time; cursors[i] holds the opaque cursor
+     * that starts page i (null for the first page).
      * @type {{}|*}
      */
     $scope.pagination = $scope.pagination || {};
-    $scope.pagination.currentPage = 0;
     $scope.pagination.pageSize = 20;
+
+    /**
+     * Forgets the cursors of the previous query and goes back to the first page.
+     */
+    $scope.pagination.reset = function () {
+        $scope.pagination.currentPage = 0;
+        $scope.pagination.cursors = [null];
+        $scope.pagination.more = false;
+    };
+    $scope.pagination.reset();
+
     /**
-     * Returns the number of the pages in the pagination.
+     * Returns true if the selected tab is paged by the server.
      *
-     * @returns {number}
+     * @returns {boolean}
      */
-    $scope.pagination.numberOfPages = function () {
-        return Math.ceil($scope.conferences.length / $scope.pagination.pageSize);
+    $scope.pagination.isServerPaged = function () {
+        return $scope.selectedTab == 'ALL' || $scope.selectedTab == 'YOU_HAVE_CREATED';
     };
 
     /**
-     * Returns an array including the numbers from 1 to the number of the pages.
+     * Returns true if there is a page after the current one.
      *
-     * @returns {Array}
+     * @returns {boolean}
+     */
+    $scope.pagination.hasNext = function () {
+        return $scope.pagination.currentPage < $scope.pagination.cursors.length - 1;
+    };
+
+    /**
+     * Records the cursor returned by the server for the page after the current one.
+     *
+     * @param resp the response of a paged API call
+     */
+    $scope.pagination.update = function (resp) {
+        var cursors = $scope.pagination.cursors;
+        cursors.length = $scope.pagination.currentPage + 1;
+        $scope.pagination.more = !!resp.more;
+        if (resp.more && resp.nextCursor) {
+            cursors.push(resp.nextCursor);
+        }
+    };
+
+    /**
+     * Fetches the page specified by the index, if its cursor is known.
+     *
+     * @param page the index of the page
      */
-    $scope.pagination.pageArray = function () {
-        var pages = [];
-        var numberOfPages = $scope.pagination.numberOfPages();
-        for (var i = 0; i < numberOfPages; i++) {
-            pages.push(i);
+    $scope.pagination.goTo = function (page) {
+        if (page < 0 || page >= $scope.pagination.cursors.length) {
+            return;
         }
-        return pages;
+        $scope.pagination.currentPage = page;
+        $scope.fetchConferencesPage();
     };
 
     /**
@@ -390,6 +456,21 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
         })
     };
 
+    /**
+     * Adds a filter for conferences whose field equals a facet value.
+     */
+    $scope.addFacetFilter = function (field, value) {
+        for (var i = 0; i < $scope.filtereableFields.length; i++) {
+            if ($scope.filtereableFields[i].enumValue == field) {
+                $scope.filters.push({
+                    field: $scope.filtereableFields[i],
+                    operator: $scope.operators[0],
+                    value: value
+                });
+            }
+        }
+    };
+
     /**
      * Clears all filters.
      */
@@ -413,6 +494,17 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      *
      */
     $scope.queryConferences = function () {
+        $scope.pagination.reset();
+        $scope.pagination.filters = $scope.buildFilters();
+        $scope.pagination.query = $scope.searchText;
+        $scope.fetchConferencesPage();
+    };
+
+    /**
+     * Fetches the current page of conferences depending on the tab currently selected.
+     *
+     */
+    $scope.fetchConferencesPage = function () {
         $scope.submitted = false;
         if ($scope.selectedTab == 'ALL') {
             $scope.queryConferencesAll();
@@ -424,24 +516,44 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
     };
 
     /**
-     * Invokes the conference.queryConferences API.
+     * Returns the complete filters in the form expected by the conference.queryConferences API.
+     *
+     * @returns {Array}
      */
-    $scope.queryConferencesAll = function () {
-        var sendFilters = {
-            filters: []
-        }
+    $scope.buildFilters = function () {
+        var filters = [];
         for (var i = 0; i < $scope.filters.length; i++) {
             var filter = $scope.filters[i];
             if (filter.field && filter.operator && filter.value) {
-                sendFilters.filters.push({
+                filters.push({
                     field: filter.field.enumValue,
                     operator: filter.operator.enumValue,
                     value: filter.value
                 });
             }
         }
+        return filters;
+    };
+
+    /**
+     * Invokes the conference.queryConferences API for the current page, or
+     * conference.searchConferences when there are words to search for.
+     */
+    $scope.queryConferencesAll = function () {
+        var sendFilters = {
+            pageSize: $scope.pagination.pageSize,
+            cursor: $scope.pagination.cursors[$scope.pagination.currentPage],
+            view: 'SUMMARY'
+        };
+        var method = gapi.client.conference.queryConferences;
+        if ($scope.pagination.query) {
+            sendFilters.query = $scope.pagination.query;
+            method = gapi.client.conference.searchConferences;
+        } else {
+            sendFilters.filters = $scope.pagination.filters || [];
+        }
         $scope.loading = true;
-        gapi.client.conference.queryConferences(sendFilters).
+        method(sendFilters).
             execute(function (resp) {
                 $scope.$apply(function () {
                     $scope.loading = false;
@@ -454,12 +566,14 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                     } else {
                         // The request has succeeded.
                         $scope.submitted = false;
-                        $scope.messages = 'Query succeeded : ' + JSON.stringify(sendFilters);
+                        $scope.messages = 'Query succeeded : ' +
+                            (sendFilters.query || JSON.stringify(sendFilters.filters));
                         $scope.alertStatus = 'success';
                         $log.info($scope.messages);
 
+                        $scope.pagination.update(resp);
                         $scope.conferences = [];
-                        angular.forEach(resp.items, function (conference) {
+                        angular.forEach(resp.summaries, function (conference) {
                             $scope.conferences.push(conference);
                         });
                     }
@@ -469,11 +583,15 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
     }
 
     /**
-     * Invokes the conference.getConferencesCreated method.
+     * Invokes the conference.getConferencesCreated method for the current page.
      */
     $scope.getConferencesCreated = function () {
         $scope.loading = true;
-        gapi.client.conference.getConferencesCreated().
+        gapi.client.conference.getConferencesCreated({
+            pageSize: $scope.pagination.pageSize,
+            cursor: $scope.pagination.cursors[$scope.pagination.currentPage],
+            view: 'SUMMARY'
+        }).
             execute(function (resp) {
                 $scope.$apply(function () {
                     $scope.loading = false;
@@ -495,8 +613,9 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         $scope.alertStatus = 'success';
                         $log.info($scope.messages);
 
+                        $scope.pagination.update(resp);
                         $scope.conferences = [];
-                        angular.forEach(resp.items, function (conference) {
+                        angular.forEach(resp.summaries, function (conference) {
                             $scope.conferences.push(conference);
                         });
                     }
@@ -511,8 +630,8 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.getConferencesAttend = function () {
         $scope.loading = true;
-        gapi.client.conference.getConferencesToAttend().
-            execute(function (resp) {
+        etagCache.execute('getConferencesToAttend', {view: 'SUMMARY'},
+            function (resp) {
                 $scope.$apply(function () {
                     if (resp.error) {
                         // The request has failed.
@@ -527,7 +646,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         }
                     } else {
                         // The request has succeeded.
-                        $scope.conferences = resp.result.items;
+                        $scope.conferences = resp.result.summaries || [];
                         $scope.loading = false;
                         $scope.messages = 'Query succeeded : Conferences you will attend (or you have attended)';
                         $scope.alertStatus = 'success';
@@ -547,7 +666,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
  * @description
  * A controller used for the conference detail page.
  */
-conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $log, $routeParams, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $log, $routeParams, etagCache, HTTP_ERRORS) {
     $scope.conference = {};
 
     $scope.isUserAttending = false;
@@ -559,9 +678,9 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
      */
     $scope.init = function () {
         $scope.loading = true;
-        gapi.client.conference.getConference({
+        etagCache.execute('getConference', {
             websafeConferenceKey: $routeParams.websafeConferenceKey
-        }).execute(function (resp) {
+        }, function (resp) {
             $scope.$apply(function () {
                 $scope.loading = false;
                 if (resp.error) {
@@ -581,7 +700,7 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
 
         $scope.loading = true;
         // If the user is attending the conference, updates the status message and available function.
-        gapi.client.conference.getProfile().execute(function (resp) {
+        etagCache.execute('getProfile', {}, function (resp) {
             $scope.$apply(function () {
                 $scope.loading = false;
                 if (resp.error) {
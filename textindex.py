@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+
+"""textindex.py -- inverted index for conference full-text search
+
+Conference names and descriptions are split into tokens.  Each token's
+posting list -- the conferences containing it and the token's weight in
+each -- is a chain of SearchPosting shards of at most MAX_POSTINGS
+entries.  New postings are appended to the last shard, spilling into a
+new one when it is full; the first shard counts the shards.  A common
+word therefore grows more shards instead of one ever larger entity, and
+a rare word stays in one.  Each conference's SearchDocument records the
+tokens it was last indexed under and the shard holding each posting, so
+re-indexing after an update only rewrites the shards of tokens that were
+dropped or reweighted, and appends those that were added.
+
+Conference writes queue an index_conferences task (transactionally, so
+only committed conferences are indexed) rather than indexing in the
+request; a task that loses a race on a shard is simply retried.
+
+A search reads the first shard of each query token in one batched get
+and the remaining shards in a second (both served from ndb's memcache
+copies when warm), intersects the posting lists starting with the
+shortest and ranks the matches by weight, rarer tokens counting for more.
+
+"""
+
+import collections
+import math
+import re
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import SearchDocument
+from models import SearchPosting
+from utils import mapPage
+
+SEARCH_DOCUMENT_ID = 'search'
+INDEX_TASK_URL = '/tasks/index_conferences'
+MAX_POSTINGS = 1000     # conferences per posting list shard
+REINDEX_BATCH_SIZE = 100
+NAME_WEIGHT = 3
+DESCRIPTION_WEIGHT = 1
+MAX_TOKENS = 100        # distinct tokens indexed per conference
+MAX_QUERY_TOKENS = 10
+MIN_TOKEN_LENGTH = 2
+MAX_TOKEN_LENGTH = 100
+STOP_WORDS = frozenset((
+    'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has', 'in',
+    'is', 'it', 'its', 'of', 'on', 'or', 'that', 'the', 'this', 'to', 'was',
+    'were', 'will', 'with'))
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Return the searchable tokens of a text, lowercased, in order."""
+    return [token for token in _TOKEN_RE.findall((text or u'').lower())
+            if MIN_TOKEN_LENGTH <= len(token) <= MAX_TOKEN_LENGTH
+            and token not in STOP_WORDS]
+
+
+def weigh(conf):
+    """Return {token: weight} for a conference.
+
+    Each occurrence of a token in the name adds NAME_WEIGHT and each in the
+    description DESCRIPTION_WEIGHT; only the MAX_TOKENS heaviest are kept.
+    """
+    weights = collections.Counter()
+    for token in tokenize(conf.name):
+        weights[token] += NAME_WEIGHT
+    for token in tokenize(conf.description):
+        weights[token] += DESCRIPTION_WEIGHT
+    return dict(weights.most_common(MAX_TOKENS))
+
+
+def _postingKey(token, shard):
+    """Return the key of one shard of a token's posting list."""
+    return ndb.Key(SearchPosting, u'%s:%d' % (token, shard))
+
+
+def _documentKey(conf_key):
+    return ndb.Key(SearchDocument, SEARCH_DOCUMENT_ID, parent=conf_key)
+
+
+def _setPostings(posting, postings):
+    """Store {conference key: weight} on a posting list shard."""
+    posting.conferenceKeys = list(postings)
+    posting.weights = [postings[key] for key in posting.conferenceKeys]
+
+
+@ndb.transactional_tasklet()
+def _postAsync(posting_key, changes):
+    """Apply {conference key: weight} to the conferences already in one
+    posting list shard; a weight of 0 removes the conference."""
+    posting = yield posting_key.get_async()
+    if not posting:
+        return
+    postings = dict(zip(posting.conferenceKeys, posting.weights))
+    for conf_key, weight in changes.items():
+        if weight:
+            postings[conf_key] = weight
+        else:
+            postings.pop(conf_key, None)
+    _setPostings(posting, postings)
+    # the first shard holds the shard count, so it is kept even if empty
+    if postings or posting_key.id().endswith(u':0'):
+        yield posting.put_async()
+    else:
+        yield posting_key.delete_async()
+
+
+@ndb.transactional_tasklet(xg=True)
+def _appendAsync(token, additions):
+    """Add {conference key: weight} to the end of a token's posting list,
+    starting new shards as the last one fills up.  Return {conference
+    key: shard}.
+
+    A batch of additions is far smaller than MAX_POSTINGS, so this
+    touches at most the first shard, the last and one new shard.
+    """
+    head_key = _postingKey(token, 0)
+    head = yield head_key.get_async()
+    head = head or SearchPosting(key=head_key, shardCount=1)
+    shard = head.shardCount - 1
+    posting = head
+    if shard:
+        posting = yield _postingKey(token, shard).get_async()
+        posting = posting or SearchPosting(key=_postingKey(token, shard))
+    written = [posting]
+    postings = dict(zip(posting.conferenceKeys, posting.weights))
+    placed = {}
+    for conf_key, weight in sorted(additions.items()):
+        if len(postings) >= MAX_POSTINGS and conf_key not in postings:
+            _setPostings(posting, postings)
+            shard += 1
+            posting = SearchPosting(key=_postingKey(token, shard))
+            written.append(posting)
+            postings = {}
+        postings[conf_key] = weight
+        placed[conf_key] = shard
+    _setPostings(posting, postings)
+    if shard + 1 != head.shardCount:
+        head.shardCount = shard + 1
+        if written[0] is not head:
+            written.append(head)
+    yield ndb.put_multi_async(written)
+    raise ndb.Return(placed)
+
+
+@ndb.tasklet
+def indexAsync(conferences):
+    """Bring the index up to date with the conferences' names and
+    descriptions; call after conferences are written."""
+    doc_keys = [_documentKey(conf.key) for conf in conferences]
+    docs = yield ndb.get_multi_async(doc_keys)
+
+    # all the changes to a shard, and all the additions to a token, are
+    # made in one transaction, so a batch of conferences sharing tokens
+    # does not contend with itself
+    changes = collections.defaultdict(dict)
+    additions = collections.defaultdict(dict)
+    indexed = []
+    for conf, doc_key, doc in zip(conferences, doc_keys, docs):
+        old = dict(zip(doc.tokens, doc.weights)) if doc else {}
+        shards = dict(zip(doc.tokens, doc.shards)) if doc else {}
+        new = weigh(conf)
+        if doc and old == new:
+            continue
+        for token in set(old) | set(new):
+            if token not in old:
+                additions[token][conf.key] = new[token]
+            elif old[token] != new.get(token):
+                changes[_postingKey(token, shards[token])][conf.key] = new.get(token, 0)
+        indexed.append((doc_key, conf.key, new, shards))
+
+    # postings first: if this is cut short, the old documents make the next
+    # indexing of these conferences redo the same changes (an addition is
+    # appended again, normally onto the same last shard, where it simply
+    # overwrites itself)
+    tokens = list(additions)
+    placed = yield ([_postAsync(key, change) for key, change in changes.items()],
+                    [_appendAsync(token, additions[token]) for token in tokens])
+    placed = dict(zip(tokens, placed[1]))
+    new_docs = []
+    for doc_key, conf_key, new, shards in indexed:
+        tokens = sorted(new)
+        new_docs.append(SearchDocument(key=doc_key, tokens=tokens,
+            weights=[new[token] for token in tokens],
+            shards=[shards[token] if token in shards else placed[token][conf_key]
+                    for token in tokens]))
+    if new_docs:
+        yield ndb.put_multi_async(new_docs)
+
+
+def index(conferences):
+    """Index conferences; see indexAsync()."""
+    indexAsync(conferences).get_result()
+
+
+@ndb.tasklet
+def queueIndexAsync(conf_keys):
+    """Queue an index_conferences task for conferences being written.
+    Inside a transaction the task is only added if the transaction
+    commits."""
+    task = taskqueue.Task(url=INDEX_TASK_URL,
+        params={'websafeConferenceKey': [key.urlsafe() for key in conf_keys]})
+    yield taskqueue.Queue().add_async(task, transactional=ndb.in_transaction())
+
+
+def queueIndex(conf_keys):
+    """Queue the indexing of conferences; see queueIndexAsync()."""
+    queueIndexAsync(conf_keys).get_result()
+
+
+def indexKeys(conf_keys):
+    """Index the conferences with the given keys; run by the
+    index_conferences task."""
+    index([conf for conf in ndb.get_multi(conf_keys) if conf])
+
+
+def search(text):
+    """Return the keys of the conferences containing every token of the
+    text, best match first.
+
+    A conference scores its weight for each query token divided by the log
+    of the number of conferences containing that token; ties go in key
+    order so that pages are stable.
+    """
+    tokens = list(collections.OrderedDict.fromkeys(tokenize(text)))[:MAX_QUERY_TOKENS]
+    if not tokens:
+        return []
+    heads = ndb.get_multi([_postingKey(token, 0) for token in tokens])
+    if not all(heads):
+        return []
+    rest_keys = [_postingKey(token, shard) for token, head in zip(tokens, heads)
+                 for shard in range(1, head.shardCount)]
+    rest = dict(zip(rest_keys, ndb.get_multi(rest_keys)))
+
+    postings = []
+    for token, head in zip(tokens, heads):
+        merged = dict(zip(head.conferenceKeys, head.weights))
+        for shard in range(1, head.shardCount):
+            posting = rest[_postingKey(token, shard)]
+            if posting:
+                merged.update(zip(posting.conferenceKeys, posting.weights))
+        if not merged:
+            return []
+        postings.append(merged)
+
+    postings.sort(key=len)
+    matches = list(postings[0])
+    for merged in postings[1:]:
+        matches = [key for key in matches if key in merged]
+        if not matches:
+            return []
+
+    scores = dict((key, sum(merged[key] / math.log(2 + len(merged))
+                            for merged in postings))
+                  for key in matches)
+    return sorted(matches, key=lambda key: (-scores[key], key.urlsafe()))
+
+
+def reindex(cursor=None):
+    """Index one batch of conferences, for those that predate the index or
+    whose indexing was cut short; return the cursor of the next batch or
+    None."""
+    return mapPage(Conference.query(), index, cursor, REINDEX_BATCH_SIZE)
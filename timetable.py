@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""timetable.py -- precomputed per-conference session timetable
+
+Each conference has one Timetable child entity holding all of its sessions
+as compressed JSON rows, sorted by date and start time, plus the row
+order by start time alone for binary search.  Sessions are written by
+rebuild(), in the same transaction that rebuilds the timetable from an
+ancestor query, so the two never disagree.  The timetable is cached in
+memcache, so reading a schedule is one memcache get (one datastore get
+on a miss) however many sessions the conference has.
+
+Cached timetables are stamped with a per-conference version in memcache,
+which every rebuild bumps when it commits; a reader that loaded the old
+timetable just before a rebuild caches it under the old version, where
+it is never served.
+
+"""
+
+import bisect
+import json
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Session
+from models import SessionForm
+from models import Timetable
+
+MEMCACHE_TIMETABLE_KEY = "TIMETABLE:%s"
+MEMCACHE_VERSION_KEY = "TIMETABLE_VERSION:%s"
+TIMETABLE_ID = 'timetable'
+
+# columns of a row; date and startTime are kept as the strings SessionForm
+# carries ('2016-05-30', '19:00:00'), which sort like the values
+COLUMNS = ('id', 'name', 'highlights', 'speaker', 'duration',
+           'typeOfSession', 'date', 'startTime')
+ID, NAME, HIGHLIGHTS, SPEAKER, DURATION, TYPES, DATE, START = range(len(COLUMNS))
+
+
+def _key(conf_key):
+    return ndb.Key(Timetable, TIMETABLE_ID, parent=conf_key)
+
+
+def _cacheKey(conf_key):
+    return MEMCACHE_TIMETABLE_KEY % conf_key.urlsafe()
+
+
+def _versionKey(conf_key):
+    return MEMCACHE_VERSION_KEY % conf_key.urlsafe()
+
+
+def _row(session):
+    return [session.key.id(), session.name, session.highlights, session.speaker,
+            session.duration, session.typeOfSession,
+            str(session.date) if session.date else None,
+            str(session.startTime) if session.startTime else None]
+
+
+@ndb.transactional()
+def rebuild(conf_key, sessions=()):
+    """Put the given sessions of a conference and rebuild its timetable,
+    in one transaction.  Return the timetable as a dict."""
+    # the query sees the sessions as of the start of the transaction
+    written = dict((session.key, session) for session in sessions)
+    current = [session for session in Session.query(ancestor=conf_key)
+               if session.key not in written]
+    if written:
+        ndb.put_multi(written.values())
+    rows = sorted((_row(session) for session in current + written.values()),
+                  key=lambda row: (row[DATE] or '', row[START] or '', row[NAME]))
+    by_time = sorted((i for i, row in enumerate(rows) if row[START]),
+                     key=lambda i: rows[i][START])
+    table = {
+        'rows': rows,
+        'byTime': by_time,
+        'startTimes': [rows[i][START] for i in by_time],
+    }
+    Timetable(key=_key(conf_key), data=json.dumps(table),
+              sessionCount=len(rows)).put()
+    ndb.get_context().call_on_commit(lambda: memcache.incr(
+        _versionKey(conf_key), initial_value=int(time.time() * 1000)))
+    return table
+
+
+def get(conf_key):
+    """Return a conference's timetable as a dict with 'rows' (sorted by
+    date and start time), 'byTime' (row indexes by start time) and
+    'startTimes'; None if the conference does not exist.
+
+    Conferences whose sessions predate timetables get one on first read.
+    """
+    cache_key, version_key = _cacheKey(conf_key), _versionKey(conf_key)
+    cached = memcache.get_multi([cache_key, version_key])
+    version = cached.get(version_key)
+    if version is None:
+        memcache.add(version_key, int(time.time() * 1000))
+        version = memcache.get(version_key)
+    elif cached.get(cache_key) and cached[cache_key][0] == version:
+        return cached[cache_key][1]
+
+    entity = _key(conf_key).get()
+    if entity:
+        table = json.loads(entity.data)
+    elif conf_key.get():
+        table = rebuild(conf_key)
+    else:
+        return None
+    if version is not None:
+        memcache.set(cache_key, (version, table))
+    return table
+
+
+def withType(table, type_of_session):
+    """Return the rows of sessions of the given type."""
+    return [row for row in table['rows'] if type_of_session in row[TYPES]]
+
+
+def startingBy(table, start_time, exclude_type=None):
+    """Return the rows of sessions starting at or before start_time (an
+    'HH:MM:SS' string), in start time order, optionally leaving out one
+    type of session."""
+    end = bisect.bisect_right(table['startTimes'], start_time)
+    rows = [table['rows'][i] for i in table['byTime'][:end]]
+    if exclude_type:
+        rows = [row for row in rows if exclude_type not in row[TYPES]]
+    return rows
+
+
+def toForms(conf_key, rows):
+    """Return SessionForms for timetable rows of the given conference."""
+    return [SessionForm(
+        websafeKey=ndb.Key(Session, row[ID], parent=conf_key).urlsafe(),
+        name=row[NAME], highlights=row[HIGHLIGHTS], speaker=row[SPEAKER],
+        duration=row[DURATION], typeOfSession=row[TYPES],
+        date=row[DATE], startTime=row[START]) for row in rows]
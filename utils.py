@@ -4,6 +4,7 @@ import time
 import uuid
 
 from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
 from models import Profile
 
 def getUserId(user, id_type="email"):
@@ -43,3 +44,14 @@ def getUserId(user, id_type="email"):
             return profile.id()
         else:
             return str(uuid.uuid1().get_hex())
+
+
+def mapPage(query, function, cursor=None, batch_size=100, keys_only=False):
+    """Call function with one page of query results, starting at the
+    urlsafe cursor; return the cursor of the next page, or None after the
+    last.  Used by the task chains that walk a whole kind in batches."""
+    start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    results, next_cursor, more = query.fetch_page(batch_size,
+        start_cursor=start_cursor, keys_only=keys_only)
+    function(results)
+    return next_cursor.urlsafe() if (more and next_cursor) else None